@@ -139,7 +139,7 @@ def list_storefronts(directory):
 
 if __name__ == "__main__":
     # Set up the LM
-    model = dspy.LM('openai/gpt-4o-mini', api_key=os.environ['OPENAI_API_KEY'])
+    model = dspy.LM('openai/gpt-4o-mini', api_key=os.environ['OPENAI_API_KEY'], api_base=os.getenv('OPENAI_BASE_URL'))
     dspy.settings.configure(lm=model)
 
     # Directory containing the HTML files
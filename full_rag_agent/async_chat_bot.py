@@ -0,0 +1,329 @@
+"""Asyncio version of chat_bot.Conversation, so one process can serve many chat sessions on one event loop.
+
+Every AsyncConversation shares one AsyncOpenAI client (and its connection pool). Nothing is printed: each
+step of a turn is passed to an `on_event` callback instead, so a web service can forward it to its client.
+"""
+import asyncio
+import inspect
+import os
+import sys
+import time
+from pathlib import Path
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+if __name__ == "__main__":
+    # run as a script: llm_utils lives at the repo root, which isn't on the path yet
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from chat_bot import SavedMessages, StreamedResponse, ToolMemo, TurnBudgets, parse_tool_call
+
+async_client = None
+
+def get_async_client():
+    """Returns the AsyncOpenAI client shared by every conversation, creating it on first use.
+
+    OPENAI_MAX_CONNECTIONS (default 100) sizes its connection pool.
+    """
+    global async_client
+    if async_client is None:
+        max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+        async_client = AsyncOpenAI(
+            base_url=os.getenv("OPENAI_BASE_URL"),
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            ),
+        )
+    return async_client
+
+async def close_async_client():
+    global async_client
+    if async_client is not None:
+        await async_client.close()
+        async_client = None
+
+
+class AsyncStreamedResponse(StreamedResponse):
+    """StreamedResponse over an async stream"""
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            delta = self.add_chunk(chunk)
+            if delta:
+                yield delta
+        self.finish()
+
+
+async def call_maybe_async(function, *args, **kwargs):
+    """Awaits async functions and runs sync ones in a thread, so a blocking tool doesn't stall the event loop"""
+    if inspect.iscoroutinefunction(function):
+        return await function(*args, **kwargs)
+    return await asyncio.to_thread(function, *args, **kwargs)
+
+
+class AsyncConversation(TurnBudgets, SavedMessages):
+    """One chat session. Tool functions may be sync or async, and their `batch` attribute works as in Conversation.
+
+    `on_event` (sync or async) is called with a dict for every step of a turn, its "type" is one of
+    "assistant_delta" (a piece of streamed text), "assistant" (a whole message), "tool_call", "tool_result", "timing", "budget_hit" and "tokens" (with a context window).
+    """
+    def __init__(self, model, tools, tool_lookup, system=None, messages=None, on_event=None, max_tool_workers=8, tool_timeout=30, stream=True, context=None,
+                 max_tool_rounds=None, max_tool_calls=None, max_turn_tokens=None, turn_timeout=None, store=None, session_id=None):
+        self.client = get_async_client()
+        self.model = model
+        # sessions are saved and resumed as in Conversation. The session is read here, which is quick enough for SQLite
+        self.store = store
+        self.session_id = session_id or (store.new_session_id() if store is not None else None)
+        self.saved_count = 0
+        if store is not None and messages is None:
+            messages = store.load(self.session_id)
+            self.saved_count = len(messages)
+        self.messages = messages or []
+        self.tools = tools
+        self.tool_lookup = tool_lookup
+        self.on_event = on_event
+        self.tool_semaphore = asyncio.Semaphore(max_tool_workers)
+        self.tool_timeout = tool_timeout
+        self.stream = stream
+        self.timings = []
+        self.context = context
+        self.token_counts = []
+        self.tool_memo = ToolMemo()
+        # per-turn budgets, as in Conversation
+        self.max_tool_rounds = max_tool_rounds
+        self.max_tool_calls = max_tool_calls
+        self.max_turn_tokens = max_turn_tokens
+        self.turn_timeout = turn_timeout
+        self.budget_hits = []
+        if system and not self.saved_count:
+            if len(self.messages) > 0 and self.messages[0]["role"] != "system":
+                self.messages.insert(0, {"role": "system", "content": system})
+            if len(self.messages) == 0:
+                self.messages.append({"role": "system", "content": system})
+        self.unsaved = list(self.messages[self.saved_count:]) if store is not None else []
+
+    async def save(self):
+        """SavedMessages.save, in a thread since the store may be waiting on another worker's write"""
+        await asyncio.to_thread(super().save)
+
+    async def emit(self, event):
+        if self.on_event is not None:
+            # rendering callbacks are quick, so sync ones run inline
+            result = self.on_event(event)
+            if inspect.isawaitable(result):
+                await result
+
+    async def fit_context(self, turn):
+        """Compacts self.messages to the context window's budget, in a thread since summarizing calls the API"""
+        if self.context is None:
+            return
+        before = self.context.counter.count(self.messages)
+        self.messages = await asyncio.to_thread(self.context.fit, self.messages)
+        after = self.context.counter.count(self.messages)
+        turn["prompt_tokens"].append(after)
+        turn["compacted_tokens"] += before - after
+
+    def request_kwargs(self, messages, tool_choice="auto"):
+        kwargs = dict( model=self.model,
+            messages=messages,
+            max_tokens=3000,
+            temperature=0.7,
+        )
+        if self.tools:
+            kwargs["tools"] = self.tools
+            kwargs["tool_choice"] = tool_choice
+        return kwargs
+
+    async def next_message(self, messages, turn, tool_choice="auto"):
+        """Gets the assistant's next message, emitting its text as it is generated when streaming"""
+        if not self.stream:
+            start = time.perf_counter()
+            response = await self.client.chat.completions.create(**self.request_kwargs(messages, tool_choice))
+            turn["generation_time"] += time.perf_counter() - start
+            if response.usage is not None:
+                turn["tokens"] += response.usage.total_tokens
+            message = response.choices[0].message
+            if message.content and turn["time_to_first_token"] is None:
+                turn["time_to_first_token"] = time.perf_counter() - turn["start"]
+            return message
+
+        start = time.perf_counter()
+        stream = await self.client.chat.completions.create(
+            stream=True, stream_options={"include_usage": True}, **self.request_kwargs(messages, tool_choice)
+        )
+        response = AsyncStreamedResponse(stream, start)
+        async for delta in response:
+            if turn["time_to_first_token"] is None:
+                turn["time_to_first_token"] = time.perf_counter() - turn["start"]
+            await self.emit({"type": "assistant_delta", "content": delta})
+        turn["generation_time"] += response.total_time
+        if response.usage is not None:
+            turn["tokens"] += response.usage.total_tokens
+        return response.message
+
+    async def run_task(self, name, function):
+        """Runs one tool task; an exception or a timeout becomes an error message for the model"""
+        async with self.tool_semaphore:
+            try:
+                return await asyncio.wait_for(function(), self.tool_timeout)
+            except asyncio.TimeoutError:
+                return f"Error: {name} timed out after {self.tool_timeout} seconds"
+            except Exception as e:
+                return f"Error: {name} failed with {type(e).__name__}: {e}"
+
+    async def call_tools(self, tool_calls):
+        """Calls the tools concurrently and returns their results in the same order as `tool_calls`.
+        Repeated calls are answered from self.tool_memo, as in Conversation.call_tools"""
+        results = [None] * len(tool_calls)
+        first_in_turn = {}
+        tasks = []
+        batches = {}
+        for i, tool_call in enumerate(tool_calls):
+            try:
+                tool, function_args = parse_tool_call(tool_call, self.tool_lookup)
+            except ValueError as e:
+                await self.emit({"type": "tool_call", "id": tool_call.id, "name": tool_call.function.name, "arguments": tool_call.function.arguments, "reused": False})
+                async def fail(error=e):
+                    raise error
+                tasks.append(([i], tool_call.function.name, fail))
+                continue
+            key = self.tool_memo.key(tool_call.function.name, function_args) if getattr(tool, "idempotent", True) else None
+            if key in first_in_turn:
+                results[i] = self.tool_memo.reference(tool_calls[first_in_turn[key]].id)
+            elif key is not None:
+                results[i] = self.tool_memo.get(key, self.messages)
+            await self.emit({"type": "tool_call", "id": tool_call.id, "name": tool_call.function.name, "arguments": function_args, "reused": results[i] is not None})
+            if results[i] is not None:
+                continue
+            if key is not None:
+                first_in_turn[key] = i
+            if hasattr(tool, "batch"):
+                batches.setdefault(tool_call.function.name, []).append((i, function_args))
+            else:
+                async def call(tool=tool, args=function_args):
+                    return [await call_maybe_async(tool, **args)]
+                tasks.append(([i], tool_call.function.name, call))
+        for name, calls in batches.items():
+            async def call(batch=self.tool_lookup[name].batch, calls=calls):
+                return await call_maybe_async(batch, [args for _, args in calls])
+            tasks.append(([i for i, _ in calls], name, call))
+
+        failed = set()
+        outcomes = await asyncio.gather(*(self.run_task(name, function) for _, name, function in tasks))
+        for (indices, name, _), outcome in zip(tasks, outcomes):
+            task_results = outcome if isinstance(outcome, list) else [outcome] * len(indices)
+            for i, result in zip(indices, task_results):
+                if not isinstance(outcome, list) or isinstance(result, Exception):
+                    failed.add(i)
+                if isinstance(result, Exception):
+                    result = f"Error: {name} failed with {type(result).__name__}: {result}"
+                results[i] = result
+        for key, i in first_in_turn.items():
+            if i not in failed:
+                self.tool_memo.put(key, tool_calls[i].id, results[i])
+        return results
+
+    async def say(self, message):
+        self.append(
+            {
+                "role": "user",
+                "content": message
+            }
+        )
+        turn = {"start": time.perf_counter(), "time_to_first_token": None, "generation_time": 0.0, "prompt_tokens": [], "compacted_tokens": 0,
+                "tool_rounds": 0, "tool_calls": 0, "tokens": 0, "budget_hit": None}
+        await self.fit_context(turn)
+        response_message = await self.next_message(self.messages, turn)
+
+        # Handle tool calls if present
+        while response_message.tool_calls:
+            if response_message.content is not None and not self.stream:
+                await self.emit({"type": "assistant", "content": response_message.content})
+            self.append(response_message)
+
+            allowed, turn["budget_hit"] = self.tool_call_allowance(turn, len(response_message.tool_calls))
+            results = []
+            if allowed:
+                results = await self.call_tools(response_message.tool_calls[:allowed])
+                turn["tool_rounds"] += 1
+                turn["tool_calls"] += allowed
+            results += [self.not_run_result(turn["budget_hit"]) for _ in response_message.tool_calls[allowed:]]
+            for tool_call, result in zip(response_message.tool_calls, results):
+                self.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "name": tool_call.function.name,
+                    "content": str(result)
+                })
+                await self.emit({"type": "tool_result", "id": tool_call.id, "name": tool_call.function.name, "content": str(result)})
+
+            turn["budget_hit"] = turn["budget_hit"] or self.exhausted_budget(turn)
+            await self.fit_context(turn)
+            response_message = await self.next_message(self.messages, turn, "none" if turn["budget_hit"] else "auto")
+            if turn["budget_hit"] and response_message.tool_calls:
+                # a server that ignores tool_choice="none" would otherwise keep the loop going on "Not run" answers
+                response_message = response_message.model_copy(update={"tool_calls": None})
+
+        self.append(response_message)
+        if response_message.content is not None:
+            await self.emit({"type": "assistant", "content": response_message.content})
+        timing = {"time_to_first_token": turn["time_to_first_token"], "generation_time": turn["generation_time"], "total_time": time.perf_counter() - turn["start"]}
+        self.timings.append(timing)
+        await self.emit({"type": "timing", **timing})
+        if turn["budget_hit"]:
+            budget_hit = {"budget": turn["budget_hit"], "tool_rounds": turn["tool_rounds"], "tool_calls": turn["tool_calls"], "tokens": turn["tokens"], "seconds": timing["total_time"]}
+            self.budget_hits.append(budget_hit)
+            await self.emit({"type": "budget_hit", **budget_hit})
+        if self.context is not None:
+            token_count = {"prompt_tokens": turn["prompt_tokens"], "compacted_tokens": turn["compacted_tokens"]}
+            self.token_counts.append(token_count)
+            await self.emit({"type": "tokens", **token_count})
+        await self.save()
+        return response_message.content
+
+
+if __name__ == "__main__":
+    # several independent sessions on one event loop, each with a slow async tool
+    TOOLS = [
+        {
+            "type": "function",
+            "function": {
+                "name": "get_weather",
+                "description": "Get the current weather for a given location",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "location": {
+                            "type": "string",
+                            "description": "The location to get the weather for (e.g., New York, San Francisco)"
+                        }
+                    },
+                    "required": ["location"]
+                }
+            }
+        }
+    ]
+
+    async def get_weather(location):
+        """Mock async function to get weather for a given location"""
+        await asyncio.sleep(1)
+        mock_weather = {
+            "New York City": "20°C, sunny",
+            "New York": "20°C, sunny",
+            "San Francisco": "15°C, cloudy",
+            "Miami": "25°C, rainy",
+        }
+        return mock_weather.get(location, f"Weather not found for {location}")
+
+    async def session(name, question):
+        def on_event(event):
+            if event["type"] in ("assistant", "tool_call", "timing"):
+                print(f"[{name}] {event}")
+        conv = AsyncConversation("gpt-4.1", TOOLS, {"get_weather": get_weather}, "You are a helpful assistant.", on_event=on_event)
+        await conv.say(question)
+
+    async def main():
+        questions = ["What's the weather in Miami?", "Is it sunny in New York?", "Compare San Francisco and Miami weather."]
+        await asyncio.gather(*(session(f"session {i}", q) for i, q in enumerate(questions)))
+        await close_async_client()
+
+    asyncio.run(main())
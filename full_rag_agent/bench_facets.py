@@ -0,0 +1,46 @@
+"""Compares search latency with the product_class facets aggregated live vs served from facet_snapshot.json.
+
+Run index_docs.py first so the snapshot exists. Uses the queries in the snapshot, with the result cache off.
+Writes the results to bench_results/facets_<timestamp>.json.
+python bench_facets.py [repeats]
+"""
+import sys
+import time
+
+import numpy as np
+
+import search_docs
+from bench_report import percentiles, write_report
+from search_docs import facet_snapshot, high_level_search
+
+def bench(mode, queries, repeats):
+    search_docs.facet_mode = mode
+    latencies = []
+    took = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            results = high_level_search(query, use_cache=False)
+            latencies.append(1000 * (time.perf_counter() - start))
+            took.append(results.get("took", 0))
+    return {"latency": percentiles(latencies), "mean_es_took_ms": float(np.mean(took))}
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    facet_snapshot.reload_if_changed()
+    queries = list(facet_snapshot.facets)
+    if not queries:
+        sys.exit(f"No facet snapshot at {facet_snapshot.path}, run index_docs.py first")
+
+    # one untimed pass so both modes see warm caches
+    bench("live", queries, 1)
+    live = bench("live", queries, repeats)
+    snapshot = bench("snapshot", queries, repeats)
+    _, output = write_report("facets", {"queries": len(queries), "repeats": repeats}, {"live": live, "snapshot": snapshot})
+
+    print(f"{len(queries)} queries x {repeats} repeats")
+    print(f"{'':10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'es took ms':>12}")
+    for name, result in [("live", live), ("snapshot", snapshot)]:
+        latency = result["latency"]
+        print(f"{name:10}{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}{result['mean_es_took_ms']:>12.2f}")
+    print(f"Wrote {output}")
@@ -0,0 +1,205 @@
+"""Load test for rag_bot: N concurrent shoppers running scripted conversations through Conversation.
+
+Reports p50/p95/p99 latency of every turn, LLM call and tool call, throughput and error rates, and writes them to
+bench_results/ as JSON so runs can be compared over time. With --mock the LLM is llm_utils.mock_openai, started in
+process, and with --backend bm25 search runs in process too, so nothing leaves the machine.
+python bench_load.py --mock --backend bm25 --concurrency 8 --conversations 40
+"""
+import argparse
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bench_report import percentiles, write_report
+
+# llm_utils (the mock server) lives at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+scenarios = [
+    ["I need a standing desk for a small home office", "Something under 48 inches wide, with good reviews"],
+    ["Looking for a sofa for my living room", "Mid century modern, grey or blue", "Do any of those come as a sectional?"],
+    ["What bar stools do you have?", "Counter height please, with a back"],
+    ["I want an area rug for a dining room", "Washable, 8x10"],
+    ["Show me coffee tables", "Something with storage", "Rated at least 4 stars"],
+    ["I need bedding for a queen bed", "Cotton sheets in white"],
+]
+
+
+class Recorder:
+    """Latencies (ms) and error counts, shared by every worker thread"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"turn": [], "llm_call": [], "tool_call": []}
+        self.errors = {"turn": 0, "llm_call": 0, "tool_call": 0}
+        self.budget_hits = {}
+
+    def record(self, kind, start, error=False):
+        with self.lock:
+            self.latencies[kind].append(1000 * (time.perf_counter() - start))
+            self.errors[kind] += error
+
+
+def make_conversation(recorder, **conversation_options):
+    """A rag_bot Conversation that records the latency of its LLM and tool calls"""
+    from chat_bot import Conversation
+    from context_window import ContextWindow
+    from rag_bot import model, prefetch_search, search_prefetcher, system, tool_lookup, tools, turn_budgets
+
+    class TimedConversation(Conversation):
+        def next_message(self, messages, turn, tool_choice="auto"):
+            start = time.perf_counter()
+            try:
+                message = super().next_message(messages, turn, tool_choice)
+            except Exception:
+                recorder.record("llm_call", start, error=True)
+                raise
+            recorder.record("llm_call", start)
+            return message
+
+        def call_tools(self, tool_calls):
+            results = super().call_tools(tool_calls)
+            # a timed out call never finishes, so its timed tool can't count it
+            timed_out = sum(isinstance(result, str) and " timed out after " in result for result in results)
+            if timed_out:
+                with recorder.lock:
+                    recorder.errors["tool_call"] += timed_out
+            return results
+
+    def timed(tool):
+        """Records one tool_call sample per call, also for the calls a batch function answers together"""
+        @functools.wraps(tool)
+        def call(**kwargs):
+            start = time.perf_counter()
+            try:
+                result = tool(**kwargs)
+            except Exception:
+                recorder.record("tool_call", start, error=True)
+                raise
+            recorder.record("tool_call", start)
+            return result
+
+        if hasattr(tool, "batch"):
+            def batch(list_of_kwargs):
+                start = time.perf_counter()
+                try:
+                    results = tool.batch(list_of_kwargs)
+                except Exception:
+                    for _ in list_of_kwargs:
+                        recorder.record("tool_call", start, error=True)
+                    raise
+                # every call in the batch waited for the whole batch, and batches return failed calls as exceptions
+                for result in results:
+                    recorder.record("tool_call", start, error=isinstance(result, Exception))
+                return results
+            call.batch = batch
+        return call
+
+    # configured like rag_bot.main
+    return TimedConversation(model, tools, {name: timed(tool) for name, tool in tool_lookup.items()}, system, context=ContextWindow(model=model),
+                             prefetch=search_prefetcher.start if prefetch_search else None, **turn_budgets, **conversation_options)
+
+
+def run_conversation(script, recorder, conversation_options):
+    conversation = make_conversation(recorder, **conversation_options)
+    for message in script:
+        start = time.perf_counter()
+        try:
+            conversation.say(message)
+        except Exception:
+            recorder.record("turn", start, error=True)
+            # the conversation can't go on without the assistant's reply
+            break
+        recorder.record("turn", start)
+    with recorder.lock:
+        for hit in conversation.budget_hits:
+            recorder.budget_hits[hit["budget"]] = recorder.budget_hits.get(hit["budget"], 0) + 1
+
+
+def run(concurrency, conversations, conversation_options):
+    from rag_bot import prefetch_search, search_prefetcher
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    # Conversation prints every step, which would only slow the shoppers down
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for i in range(conversations):
+                pool.submit(run_conversation, scenarios[i % len(scenarios)], recorder, conversation_options)
+    elapsed = time.perf_counter() - start
+    turns = len(recorder.latencies["turn"])
+    return {
+        "elapsed_s": elapsed,
+        "throughput": {
+            "turns_per_s": turns / elapsed,
+            "llm_calls_per_s": len(recorder.latencies["llm_call"]) / elapsed,
+            "conversations_per_s": conversations / elapsed,
+        },
+        "latency": {kind: percentiles(values) for kind, values in recorder.latencies.items()},
+        "errors": {kind: count for kind, count in recorder.errors.items()},
+        "error_rate": {kind: count / max(len(recorder.latencies[kind]), 1) for kind, count in recorder.errors.items()},
+        # turns cut short by rag_bot.turn_budgets, by budget
+        "budget_hits": recorder.budget_hits,
+        "search_prefetch": search_prefetcher.stats() if prefetch_search else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test for rag_bot")
+    parser.add_argument("--concurrency", type=int, default=8, help="simultaneous shoppers")
+    parser.add_argument("--conversations", type=int, default=40, help="scripted conversations to run in total")
+    parser.add_argument("--scenarios", type=Path, help="JSON file with a list of conversations, each a list of user messages")
+    parser.add_argument("--backend", choices=["elasticsearch", "bm25"], default=os.getenv("SEARCH_BACKEND", "elasticsearch"))
+    parser.add_argument("--no-search-cache", action="store_true", help="send every search to the backend")
+    parser.add_argument("--no-prefetch", action="store_true", help="don't search for the user's message while the model plans its searches")
+    parser.add_argument("--stream", action="store_true", help="stream completions")
+    parser.add_argument("--mock", action="store_true", help="answer LLM calls with llm_utils.mock_openai, started in this process")
+    parser.add_argument("--mock-port", type=int, default=8200)
+    parser.add_argument("--mock-latency", default="lognormal:-1,0.5", help="see llm_utils.mock_openai --latency")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", type=Path, help="defaults to bench_results/load_<timestamp>.json")
+    args = parser.parse_args()
+
+    if args.scenarios:
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+    if args.mock:
+        from llm_utils import mock_openai
+        mock_server, _ = mock_openai.start(args.mock_port, latency=args.mock_latency, error_rate=args.mock_error_rate)
+        os.environ["OPENAI_BASE_URL"] = f"http://localhost:{args.mock_port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+    if args.no_prefetch:
+        os.environ["PREFETCH_SEARCH"] = "0"
+    import search_docs
+    search_docs.search_backend = args.backend
+    if args.no_search_cache:
+        search_docs.search_cache.max_size = 0
+
+    config = {
+        "concurrency": args.concurrency,
+        "conversations": args.conversations,
+        "backend": args.backend,
+        "search_cache": not args.no_search_cache,
+        "prefetch": not args.no_prefetch,
+        "stream": args.stream,
+        "llm": f"mock {args.mock_latency}, error rate {args.mock_error_rate}" if args.mock else os.getenv("OPENAI_BASE_URL", "openai"),
+    }
+    report, output = write_report("load", config, run(args.concurrency, args.conversations, {"stream": args.stream}), args.output)
+
+    print(f"{args.conversations} conversations, {args.concurrency} at a time, {report['elapsed_s']:.1f}s")
+    print(f"{report['throughput']['turns_per_s']:.2f} turns/s, {report['throughput']['llm_calls_per_s']:.2f} llm calls/s")
+    print(f"{'':12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for kind, stats in report["latency"].items():
+        if stats["count"]:
+            print(f"{kind:12}{stats['count']:>8}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{report['errors'][kind]:>8}")
+    if report["search_prefetch"]:
+        print(f"Search prefetch: {report['search_prefetch']}")
+    if report["budget_hits"]:
+        print(f"Turns stopped by a budget: {report['budget_hits']}")
+    print(f"Wrote {output}")
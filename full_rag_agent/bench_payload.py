@@ -0,0 +1,69 @@
+"""Compares how many bytes a search moves and how long its JSON takes to decode, full vs compact results.
+
+Talks to elasticsearch over plain HTTP so the raw response bytes can be measured before they are decoded.
+Writes the results to bench_results/payload_<timestamp>.json.
+python bench_payload.py [repeats]
+"""
+import json
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+from bench_report import percentiles, write_report
+from search_docs import api_key, build_search_query, compact_filter_path, index_name
+
+es_url = "http://localhost:9200"
+queries = [
+    {"query_string": "standing desk"},
+    {"query_string": "sofa", "min_average_rating": 4},
+    {"query_string": "area rug", "num_results": 10},
+    {"query_string": "bar stools", "product_class": "Bar Stools"},
+    {"query_string": "mid century modern coffee table"},
+]
+
+def raw_search(search_query, filter_path=None):
+    """Returns (response bytes, seconds for the round trip)"""
+    url = f"{es_url}/{index_name}/_search"
+    if filter_path:
+        url += "?filter_path=" + ",".join(filter_path)
+    request = urllib.request.Request(url, data=json.dumps(search_query).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if api_key:
+        request.add_header("Authorization", f"ApiKey {api_key}")
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return body, time.perf_counter() - start
+
+def bench(compact, repeats):
+    sizes = []
+    decode_times = []
+    round_trips = []
+    for _ in range(repeats):
+        for kwargs in queries:
+            search_query = build_search_query(compact=compact, **kwargs)
+            body, round_trip = raw_search(search_query, compact_filter_path if compact else None)
+            start = time.perf_counter()
+            json.loads(body)
+            decode_times.append(1000 * (time.perf_counter() - start))
+            sizes.append(len(body))
+            round_trips.append(1000 * round_trip)
+    return {
+        "mean_bytes": float(np.mean(sizes)),
+        "decode": percentiles(decode_times),
+        "round_trip": percentiles(round_trips),
+    }
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    full = bench(compact=False, repeats=repeats)
+    compact = bench(compact=True, repeats=repeats)
+    _, output = write_report("payload", {"queries": len(queries), "repeats": repeats, "es_url": es_url}, {"full": full, "compact": compact})
+
+    print(f"{'':10}{'bytes/search':>15}{'decode ms':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, result in [("full", full), ("compact", compact)]:
+        print(f"{name:10}{result['mean_bytes']:>15.0f}{result['decode']['mean_ms']:>12.3f}{result['round_trip']['p50_ms']:>10.2f}{result['round_trip']['p95_ms']:>10.2f}")
+    print(f"compact moves {full['mean_bytes'] / compact['mean_bytes']:.1f}x fewer bytes")
+    print(f"Wrote {output}")
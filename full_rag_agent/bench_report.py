@@ -0,0 +1,39 @@
+"""Shared by the bench_*.py scripts: latency percentiles and the JSON reports written to bench_results/, so runs can be compared"""
+import json
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+
+results_dir = Path("./bench_results")
+
+
+def percentiles(values):
+    """count, mean and p50/p95/p99 of latencies in ms"""
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "mean_ms": float(np.mean(values)), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(name, config, results, output=None):
+    """Writes the results with the config, timestamp and git commit to `output`, by default bench_results/<name>_<timestamp>.json, and returns the report and its path"""
+    report = {
+        "benchmark": name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "config": config,
+        **results,
+    }
+    output = output or results_dir / f"{name}_{time.strftime('%Y%m%d%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    return report, output
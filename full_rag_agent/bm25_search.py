@@ -0,0 +1,339 @@
+"""In-process BM25 search over product.csv, a drop-in stand-in for elasticsearch.
+
+`high_level_search` here takes the same arguments as search_docs.high_level_search and returns the
+same hits/aggregations shape, so format_results_for_toolcall works unchanged. Set
+SEARCH_BACKEND=bm25 to make search_docs (and so rag_bot.py) use it instead of elasticsearch.
+
+The query mimics the elasticsearch one: documents must match a best_fields multi_match on the
+english-analyzed product_name/product_description, and get extra score from a phrase match on the
+same fields and from a best_fields match on the standard-analyzed (.exact) fields. The english
+analyzer is approximated with lowercasing, lucene's english stopwords and a light suffix stemmer.
+
+Build the index (also happens automatically on first search if it doesn't exist yet):
+python bm25_search.py build
+"""
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+index_path = Path(os.getenv("BM25_INDEX_PATH", "./bm25_index"))
+k1 = 1.2
+b = 0.75
+
+# lucene's default english stopwords
+stopwords = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it", "no", "not",
+    "of", "on", "or", "such", "that", "the", "their", "then", "there", "these", "they", "this", "to", "was",
+    "will", "with",
+}
+token_pattern = re.compile(r"\w+")
+fields = ["product_name", "product_description"]
+
+
+def standard_tokens(text):
+    if not isinstance(text, str):
+        return []
+    return token_pattern.findall(text.lower())
+
+def stem(token):
+    """A much lighter stand-in for the porter stemmer the english analyzer uses. Good enough to match plurals and -ing/-ed forms"""
+    if len(token) <= 3 or token.isdigit():
+        return token
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "i"
+    if token.endswith("sses"):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith("ss") and not token.endswith("us"):
+        token = token[:-1]
+    for suffix in ("ing", "ed"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    if token.endswith("y") and len(token) > 3:
+        return token[:-1] + "i"
+    return token
+
+def english_tokens(text):
+    return [stem(t) for t in standard_tokens(text) if t not in stopwords]
+
+# name of each inverted index -> (source field, analyzer)
+analyzed_fields = {
+    "product_name": ("product_name", english_tokens),
+    "product_description": ("product_description", english_tokens),
+    "product_name.exact": ("product_name", standard_tokens),
+    "product_description.exact": ("product_description", standard_tokens),
+}
+
+
+class BM25Index:
+    """Inverted indices (CSR arrays) for every analyzed field, plus the filter columns and the raw documents.
+
+    Everything is plain numpy arrays so the index can be saved with np.save and memory-mapped back.
+    """
+    def __init__(self, arrays, vocab, class_names, states, docs_file):
+        self.arrays = arrays
+        self.vocab = vocab
+        self.class_names = class_names
+        self.class_ids = {name: i for i, name in enumerate(class_names)}
+        self.states = states
+        self.num_docs = len(arrays["average_rating"])
+        self.docs_file = docs_file
+        self.docs = mmap.mmap(docs_file.fileno(), 0, access=mmap.ACCESS_READ) if self.num_docs else b""
+
+    @classmethod
+    def build(cls, path=index_path, chunk_size=5000):
+        """Reads product.csv with the same code index_docs.py uses and writes the index to `path`.
+
+        The files are written to a temporary directory next to `path` and renamed into place at the end, so a
+        concurrent reader never loads a half-written index.
+        """
+        from index_docs import chunk_to_docs, read_product_chunks, states
+
+        final_path = path
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        path = Path(tempfile.mkdtemp(prefix=f".{final_path.name}.", dir=final_path.parent))
+        vocab = {}
+        postings = {name: ([], [], []) for name in analyzed_fields}
+        doc_lengths = {name: [] for name in analyzed_fields}
+        forward = {name: ([], [0]) for name in fields}
+        class_ids = {}
+        doc_classes = ([], [0])
+        average_ratings = []
+        availability = []
+        doc_offsets = [0]
+        state_bits = {state: 1 << i for i, state in enumerate(states)}
+
+        doc_id = 0
+        with open(path / "docs.jsonl", "wb") as docs_out:
+            for chunk in read_product_chunks(chunk_size):
+                for doc in chunk_to_docs(chunk, with_embeddings=False):
+                    for name, (field, analyzer) in analyzed_fields.items():
+                        tokens = [vocab.setdefault(t, len(vocab)) for t in analyzer(doc[field])]
+                        doc_lengths[name].append(len(tokens))
+                        term_ids, tfs = np.unique(np.array(tokens, dtype=np.int32), return_counts=True)
+                        postings[name][0].append(term_ids)
+                        postings[name][1].append(np.full(len(term_ids), doc_id, dtype=np.int32))
+                        postings[name][2].append(tfs.astype(np.float32))
+                        if name in forward:
+                            forward[name][0].append(np.array(tokens, dtype=np.int32))
+                            forward[name][1].append(forward[name][1][-1] + len(tokens))
+                    doc_classes[0].extend(class_ids.setdefault(c, len(class_ids)) for c in doc["product_class"])
+                    doc_classes[1].append(len(doc_classes[0]))
+                    average_ratings.append(doc["average_rating"])
+                    availability.append(sum(state_bits[s] for s in doc["availability"]))
+
+                    line = json.dumps(doc).encode() + b"\n"
+                    docs_out.write(line)
+                    doc_offsets.append(doc_offsets[-1] + len(line))
+                    doc_id += 1
+
+        arrays = {
+            "average_rating": np.array(average_ratings, dtype=np.float32),
+            "availability": np.array(availability, dtype=np.uint64),
+            "doc_offsets": np.array(doc_offsets, dtype=np.int64),
+            "class_offsets": np.array(doc_classes[1], dtype=np.int64),
+            "class_ids": np.array(doc_classes[0], dtype=np.int32),
+        }
+        # doc id owning each entry of class_ids, used to count facets with a single bincount
+        arrays["class_docs"] = np.repeat(np.arange(doc_id, dtype=np.int32), np.diff(arrays["class_offsets"]))
+        for name, (term_ids, doc_ids, tfs) in postings.items():
+            term_ids = np.concatenate(term_ids) if term_ids else np.array([], dtype=np.int32)
+            order = np.argsort(term_ids, kind="stable")
+            arrays[f"{name}.postings_docs"] = (np.concatenate(doc_ids) if doc_ids else term_ids)[order]
+            arrays[f"{name}.postings_tfs"] = (np.concatenate(tfs) if tfs else term_ids.astype(np.float32))[order]
+            arrays[f"{name}.postings_offsets"] = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(vocab)))]).astype(np.int64)
+            arrays[f"{name}.doc_lengths"] = np.array(doc_lengths[name], dtype=np.float32)
+        # token streams of the english-analyzed fields, used to check phrase matches
+        for name, (tokens, offsets) in forward.items():
+            arrays[f"{name}.tokens"] = np.concatenate(tokens) if tokens else np.array([], dtype=np.int32)
+            arrays[f"{name}.token_offsets"] = np.array(offsets, dtype=np.int64)
+
+        for name, array in arrays.items():
+            np.save(path / f"{name}.npy", array)
+        (path / "meta.json").write_text(json.dumps({
+            "vocab": vocab,
+            "class_names": list(class_ids),
+            "states": states,
+        }))
+
+        # swap the new index in; an index that is already loaded keeps reading its (unlinked) files
+        old_path = None
+        if final_path.exists():
+            old_path = Path(tempfile.mkdtemp(prefix=f".{final_path.name}.old.", dir=final_path.parent))
+            final_path.rename(old_path / final_path.name)
+        path.rename(final_path)
+        if old_path is not None:
+            shutil.rmtree(old_path)
+        return cls.load(final_path)
+
+    @classmethod
+    def load(cls, path=index_path):
+        """Memory-maps a saved index, so loading is instant and the OS pages the arrays in as searches touch them"""
+        meta = json.loads((path / "meta.json").read_text())
+        arrays = {p.name[:-len(".npy")]: np.load(p, mmap_mode="r") for p in path.glob("*.npy")}
+        return cls(arrays, meta["vocab"], meta["class_names"], meta["states"], open(path / "docs.jsonl", "rb"))
+
+    def doc(self, doc_id):
+        offsets = self.arrays["doc_offsets"]
+        return json.loads(self.docs[offsets[doc_id]:offsets[doc_id + 1]])
+
+    def postings(self, name, term):
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return None, None
+        offsets = self.arrays[f"{name}.postings_offsets"]
+        start, end = offsets[term_id], offsets[term_id + 1]
+        return self.arrays[f"{name}.postings_docs"][start:end], self.arrays[f"{name}.postings_tfs"][start:end]
+
+    def field_scores(self, name, terms):
+        """BM25 score of every document for `terms` in one field, lucene style"""
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        doc_lengths = self.arrays[f"{name}.doc_lengths"]
+        average_length = doc_lengths.mean() if self.num_docs else 0
+        for term in terms:
+            doc_ids, tfs = self.postings(name, term)
+            if doc_ids is None or len(doc_ids) == 0:
+                continue
+            idf = np.log(1 + (self.num_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = k1 * (1 - b + b * doc_lengths[doc_ids] / average_length)
+            # a term appears once per document in its postings, so plain fancy indexing is safe
+            scores[doc_ids] += idf * tfs / (tfs + norm)
+        return scores
+
+    def phrase_scores(self, name, terms, term_scores):
+        """Scores documents whose token stream contains `terms` next to each other (stopwords are already gone on both sides)"""
+        if len(terms) <= 1:
+            return term_scores
+        phrase = [self.vocab.get(t) for t in terms]
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        if None in phrase:
+            return scores
+        candidates = None
+        for term in terms:
+            doc_ids, _ = self.postings(name, term)
+            candidates = doc_ids if candidates is None else np.intersect1d(candidates, doc_ids, assume_unique=True)
+        tokens = self.arrays[f"{name}.tokens"]
+        offsets = self.arrays[f"{name}.token_offsets"]
+        phrase = np.array(phrase, dtype=np.int32)
+        for doc_id in candidates:
+            doc_tokens = tokens[offsets[doc_id]:offsets[doc_id + 1]]
+            if len(doc_tokens) >= len(phrase):
+                windows = np.lib.stride_tricks.sliding_window_view(doc_tokens, len(phrase))
+                if (windows == phrase).all(axis=1).any():
+                    scores[doc_id] = term_scores[doc_id]
+        return scores
+
+    def filter_mask(self, availability=None, product_class=None, min_average_rating=None):
+        mask = np.ones(self.num_docs, dtype=bool)
+        if availability:
+            if availability not in self.states:
+                return np.zeros(self.num_docs, dtype=bool)
+            bit = np.uint64(1 << self.states.index(availability))
+            mask &= (self.arrays["availability"] & bit) != 0
+        if product_class:
+            class_mask = np.zeros(self.num_docs, dtype=bool)
+            class_id = self.class_ids.get(product_class)
+            if class_id is not None:
+                class_mask[self.arrays["class_docs"][self.arrays["class_ids"] == class_id]] = True
+            mask &= class_mask
+        if min_average_rating:
+            mask &= self.arrays["average_rating"] >= min_average_rating
+        return mask
+
+    def class_facets(self, matched, size=10):
+        """Same shape as an elasticsearch terms aggregation on product_class over the matched documents"""
+        class_docs = self.arrays["class_docs"]
+        counts = np.bincount(self.arrays["class_ids"][matched[class_docs]], minlength=len(self.class_names))
+        # like elasticsearch: highest count first, ties broken by key
+        order = sorted(np.flatnonzero(counts), key=lambda c: (-counts[c], self.class_names[c]))
+        buckets = [{"key": self.class_names[c], "doc_count": int(counts[c])} for c in order[:size]]
+        return {
+            "doc_count_error_upper_bound": 0,
+            "sum_other_doc_count": int(sum(counts[c] for c in order[size:])),
+            "buckets": buckets,
+        }
+
+    def search(self, query_string, availability=None, product_class=None, min_average_rating=None, num_results=10):
+        start = time.time()
+        english = english_tokens(query_string)
+        exact = standard_tokens(query_string)
+
+        # must: multi_match (best_fields) on the english-analyzed fields
+        name_scores = self.field_scores("product_name", english)
+        description_scores = self.field_scores("product_description", english)
+        scores = np.maximum(name_scores, description_scores)
+        matched = (scores > 0) & self.filter_mask(availability, product_class, min_average_rating)
+
+        # should: phrase multi_match on the same fields, and multi_match on the .exact fields
+        scores += np.maximum(
+            self.phrase_scores("product_name", english, name_scores),
+            self.phrase_scores("product_description", english, description_scores),
+        )
+        scores += np.maximum(
+            self.field_scores("product_name.exact", exact),
+            self.field_scores("product_description.exact", exact),
+        )
+
+        matched_ids = np.flatnonzero(matched)
+        top = matched_ids[np.argsort(-scores[matched_ids], kind="stable")[:num_results]]
+        hits = [
+            {"_index": "wands", "_id": str(doc["product_id"]), "_score": float(scores[doc_id]), "_source": doc}
+            for doc_id, doc in ((doc_id, self.doc(doc_id)) for doc_id in top)
+        ]
+        return {
+            "took": int(1000 * (time.time() - start)),
+            "timed_out": False,
+            "hits": {
+                "total": {"value": len(matched_ids), "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            },
+            "aggregations": {"product_class": self.class_facets(matched)},
+        }
+
+
+bm25_index = None
+bm25_index_lock = threading.Lock()
+
+def get_index():
+    """Loads the index from BM25_INDEX_PATH the first time it's needed, building it from product.csv if it isn't there.
+    Concurrent first searches wait for one load or build instead of each building into the same files"""
+    global bm25_index
+    if bm25_index is None:
+        with bm25_index_lock:
+            if bm25_index is None:
+                if (index_path / "meta.json").exists():
+                    bm25_index = BM25Index.load(index_path)
+                else:
+                    bm25_index = BM25Index.build(index_path)
+    return bm25_index
+
+def high_level_search(
+        query_string,
+        availability=None,
+        product_class=None,
+        min_average_rating=None,
+        num_results=10,
+        **kwargs,
+    ):
+    """Same arguments and result shape as search_docs.high_level_search. Elasticsearch-only options (index, caching, compact) are ignored"""
+    return get_index().search(query_string, availability, product_class, min_average_rating, num_results)
+
+
+if __name__ == "__main__":
+    from search_docs import format_results_for_toolcall
+
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        start = time.time()
+        bm25_index = BM25Index.build(index_path)
+        print(f"Indexed {bm25_index.num_docs} documents into {index_path} in {time.time() - start:.1f} seconds")
+    else:
+        print(format_results_for_toolcall(high_level_search("standing desk", min_average_rating=3.9, num_results=5)))
@@ -1,20 +1,238 @@
 from openai import OpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+import inspect
 import json
+import os
+import sys
+import time
 
-class Conversation:
-    def __init__(self, model, tools, tool_lookup, system = None, messages=None):
-        self.client = OpenAI()
+if __name__ == "__main__":
+    # run as a script: llm_utils lives at the repo root, which isn't on the path yet
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from llm_utils.llm_call import LLMCaller
+
+
+class StreamedResponse:
+    """Iterates over the content deltas of a streamed completion as they arrive.
+
+    Once iterated, `message` is the reassembled ChatCompletionMessage (tool calls included), and
+    `time_to_first_token` / `total_time` are in seconds from the request.
+    """
+    def __init__(self, stream, start):
+        self.stream = stream
+        self.start = start
+        self.message = None
+        self.time_to_first_token = None
+        self.total_time = None
+        self.usage = None
+        self.content = []
+        # tool calls arrive as fragments keyed by index: the first has the id and name, the rest add to the arguments
+        self.tool_calls = {}
+
+    def add_chunk(self, chunk):
+        """Adds a chunk to the message being reassembled and returns its content delta, if any"""
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if self.time_to_first_token is None and (delta.content or delta.tool_calls):
+            self.time_to_first_token = time.perf_counter() - self.start
+        for fragment in delta.tool_calls or []:
+            tool_call = self.tool_calls.setdefault(fragment.index, {"id": None, "name": "", "arguments": ""})
+            if fragment.id:
+                tool_call["id"] = fragment.id
+            if fragment.function is not None:
+                tool_call["name"] += fragment.function.name or ""
+                tool_call["arguments"] += fragment.function.arguments or ""
+        if delta.content:
+            self.content.append(delta.content)
+        return delta.content or None
+
+    def finish(self):
+        self.total_time = time.perf_counter() - self.start
+        self.message = ChatCompletionMessage(
+            role="assistant",
+            content="".join(self.content) if self.content else None,
+            tool_calls=[
+                ChatCompletionMessageToolCall(
+                    id=tool_call["id"],
+                    type="function",
+                    function=Function(name=tool_call["name"], arguments=tool_call["arguments"]),
+                )
+                for _, tool_call in sorted(self.tool_calls.items())
+            ] or None,
+        )
+
+    def __iter__(self):
+        for chunk in self.stream:
+            delta = self.add_chunk(chunk)
+            if delta:
+                yield delta
+        self.finish()
+
+
+def parse_tool_call(tool_call, tool_lookup):
+    """Returns (tool function, argument dict) for a tool call, raising ValueError for malformed arguments, arguments
+    that don't fit the tool's signature (checked before batching, so one bad call can't fail its whole batch) or an unknown tool"""
+    tool = tool_lookup.get(tool_call.function.name)
+    if tool is None:
+        raise ValueError(f"unknown tool {tool_call.function.name!r}")
+    function_args = json.loads(tool_call.function.arguments or "{}")
+    if not isinstance(function_args, dict):
+        raise ValueError(f"arguments must be a JSON object, got {tool_call.function.arguments!r}")
+    try:
+        signature = inspect.signature(tool)
+    except (TypeError, ValueError):
+        # builtins and some callables have no signature to check against
+        return tool, function_args
+    try:
+        signature.bind(**function_args)
+    except TypeError as e:
+        raise ValueError(f"bad arguments {tool_call.function.arguments}: {e}") from None
+    return tool, function_args
+
+
+class ToolMemo:
+    """Results of the tool calls made in a conversation, keyed by tool name and canonical JSON arguments.
+
+    A repeated call gets a short reference to the earlier result while that result is still in the messages,
+    and the result itself once the earlier message has been compacted away. Tools that aren't idempotent
+    opt out with `tool.idempotent = False`.
+    """
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+
+    @staticmethod
+    def key(name, args):
+        return (name, json.dumps(args, sort_keys=True, separators=(",", ":")))
+
+    @staticmethod
+    def reference(tool_call_id):
+        return f"Same call as tool call {tool_call_id}, see its result above."
+
+    def get(self, key, messages):
+        if key not in self.results:
+            return None
+        self.hits += 1
+        tool_call_id, result = self.results[key]
+        for message in messages:
+            if isinstance(message, dict) and message.get("tool_call_id") == tool_call_id and message["content"] == result:
+                return self.reference(tool_call_id)
+        return result
+
+    def put(self, key, tool_call_id, result):
+        self.results[key] = (tool_call_id, str(result))
+
+
+class TurnBudgets:
+    """Per-turn tool loop budgets, shared by Conversation and AsyncConversation.
+
+    Expects max_tool_rounds, max_tool_calls, max_turn_tokens and turn_timeout attributes (None is unlimited)
+    and a turn dict counting the turn's tool rounds, tool calls, tokens and start time.
+    """
+    def exhausted_budget(self, turn):
+        """Returns the name of the first per-turn budget that doesn't allow another tool call, or None"""
+        if self.max_tool_rounds is not None and turn["tool_rounds"] >= self.max_tool_rounds:
+            return "tool_rounds"
+        if self.max_tool_calls is not None and turn["tool_calls"] >= self.max_tool_calls:
+            return "tool_calls"
+        if self.max_turn_tokens is not None and turn["tokens"] >= self.max_turn_tokens:
+            return "tokens"
+        if self.turn_timeout is not None and time.perf_counter() - turn["start"] >= self.turn_timeout:
+            return "time"
+        return None
+
+    def tool_call_allowance(self, turn, num_calls):
+        """Returns (how many of the next round's `num_calls` tool calls may run, the budget that stops the rest or None).
+        A round that would go over max_tool_calls still runs the calls that fit"""
+        budget = self.exhausted_budget(turn)
+        if budget:
+            return 0, budget
+        if self.max_tool_calls is not None and turn["tool_calls"] + num_calls > self.max_tool_calls:
+            return self.max_tool_calls - turn["tool_calls"], "tool_calls"
+        return num_calls, None
+
+    @staticmethod
+    def not_run_result(budget):
+        return f"Not run: this turn's {budget} budget ran out. Answer with what you have."
+
+
+class SavedMessages:
+    """Keeps track of the messages not yet saved to the session store, shared by Conversation and AsyncConversation.
+
+    Expects store, session_id, messages, saved_count and unsaved attributes.
+    """
+    def append(self, message):
+        self.messages.append(message)
+        if self.store is not None:
+            self.unsaved.append(message)
+
+    def save(self):
+        """Appends the messages added since the last save to the session store"""
+        if self.store is None or not self.unsaved:
+            return
+        self.store.append(self.session_id, self.unsaved, self.saved_count)
+        self.saved_count += len(self.unsaved)
+        self.unsaved = []
+
+
+class Conversation(TurnBudgets, SavedMessages):
+    def __init__(self, model, tools, tool_lookup, system = None, messages=None, max_tool_workers=8, tool_timeout=30, stream=False, context=None,
+                 max_tool_rounds=None, max_tool_calls=None, max_turn_tokens=None, turn_timeout=None, llm_timeout=60, hedge_after=None,
+                 prefetch=None, store=None, session_id=None):
+        # OPENAI_BASE_URL points every app at another OpenAI-compatible server, e.g. llm_utils.mock_openai
+        self.client = OpenAI(base_url=os.getenv("OPENAI_BASE_URL"))
+        # LLM calls are retried on rate limits and server errors for up to `llm_timeout` seconds, and with
+        # `hedge_after` a call that hasn't answered after that many seconds is sent again (see llm_utils.llm_call)
+        self.llm = LLMCaller(self.client, timeout=llm_timeout, hedge_after=hedge_after)
         self.model = model
+        # with stream=True the assistant's text is printed as it is generated, and self.timings gets
+        # the time to first token and the total generation time of every turn
+        self.stream = stream
+        self.timings = []
+        # an optional context_window.ContextWindow that keeps self.messages under a token budget;
+        # self.token_counts gets the prompt tokens of every call in each turn
+        self.context = context
+        self.token_counts = []
+        self.tool_memo = ToolMemo()
+        # called with every user message before the first LLM call, to start work the tools are likely to
+        # need (see rag_bot.search_prefetcher). It must not block
+        self.prefetch = prefetch
+        # with a session_store.SessionStore each turn's messages are saved under self.session_id, and a Conversation
+        # created with an existing session_id picks up where that session left off, in this process or another
+        self.store = store
+        self.session_id = session_id or (store.new_session_id() if store is not None else None)
+        self.saved_count = 0
+        if store is not None and messages is None:
+            messages = store.load(self.session_id)
+            self.saved_count = len(messages)
         self.messages = messages or []
         self.tools = tools
         self.tool_lookup = tool_lookup
-        if system:
+        # tool calls from the same turn run at the same time, at most `max_tool_workers` at once and each for at most `tool_timeout` seconds
+        self.max_tool_workers = max_tool_workers
+        self.tool_timeout = tool_timeout
+        # per-turn budgets (None is unlimited): rounds of tool calls, tool calls, tokens used by the LLM calls and
+        # seconds. Once one runs out the model has to answer without tools, and self.budget_hits records which one
+        self.max_tool_rounds = max_tool_rounds
+        self.max_tool_calls = max_tool_calls
+        self.max_turn_tokens = max_turn_tokens
+        self.turn_timeout = turn_timeout
+        self.budget_hits = []
+        # a resumed session keeps the system prompt it was saved with
+        if system and not self.saved_count:
             if len(self.messages) > 0 and self.messages[0]["role"] != "system":
                 self.messages.insert(0, {"role": "system", "content": system})
             if len(self.messages) == 0:
                 self.messages.append({"role": "system", "content": system})
+        self.unsaved = list(self.messages[self.saved_count:]) if store is not None else []
 
-    def get_response(self, messages=None):
+    def get_response(self, messages=None, tool_choice="auto"):
         kwargs = dict( model=self.model,
             messages=messages,
             max_tokens=3000,
@@ -22,11 +240,162 @@ class Conversation:
         )
         if self.tools:
             kwargs["tools"] = self.tools
-            kwargs["tool_choice"] = "auto"
+            kwargs["tool_choice"] = tool_choice
 
-        response = self.client.chat.completions.create(**kwargs)
+        response = self.llm.create(**kwargs)
         return response
+
+    def stream_response(self, messages=None, tool_choice="auto"):
+        """Like get_response, but returns a StreamedResponse to iterate over as the tokens arrive"""
+        kwargs = dict( model=self.model,
+            messages=messages,
+            max_tokens=3000,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        if self.tools:
+            kwargs["tools"] = self.tools
+            kwargs["tool_choice"] = tool_choice
+
+        start = time.perf_counter()
+        return StreamedResponse(self.llm.create(**kwargs), start)
+
+    def fit_context(self, turn):
+        """Compacts self.messages to the context window's budget and records how many tokens will be sent"""
+        if self.context is None:
+            return
+        before = self.context.counter.count(self.messages)
+        self.messages = self.context.fit(self.messages)
+        after = self.context.counter.count(self.messages)
+        turn["prompt_tokens"].append(after)
+        turn["compacted_tokens"] += before - after
+
+    def next_message(self, messages, turn, tool_choice="auto"):
+        """Gets the assistant's next message, streaming its text to the terminal when self.stream is set"""
+        if not self.stream:
+            response = self.get_response(messages, tool_choice)
+            if response.usage is not None:
+                turn["tokens"] += response.usage.total_tokens
+            return response.choices[0].message
+
+        green = "\033[92m"
+        bold = "\033[1m"
+        clear_color = "\033[0m"
+        response = self.stream_response(messages, tool_choice)
+        for i, delta in enumerate(response):
+            if turn["time_to_first_token"] is None:
+                turn["time_to_first_token"] = time.perf_counter() - turn["start"]
+            if i == 0:
+                print(f"\n{bold}{green}Assistant:{clear_color} {green}", end="")
+            print(delta, end="", flush=True)
+        if response.message.content is not None:
+            print(clear_color)
+        turn["generation_time"] += response.total_time
+        if response.usage is not None:
+            turn["tokens"] += response.usage.total_tokens
+        return response.message
         
+    def run_tasks(self, tasks):
+        """Runs (name, function) tasks in a thread pool and returns what each returned, in order.
+
+        A task that raises or runs longer than `tool_timeout` seconds gets an error message instead,
+        so one failing tool doesn't take down the others.
+        """
+        outcomes = [None] * len(tasks)
+        started = {}
+        def run(i, function):
+            started[i] = time.monotonic()
+            return function()
+
+        pool = ThreadPoolExecutor(max_workers=self.max_tool_workers)
+        futures = {pool.submit(run, i, function): i for i, (_, function) in enumerate(tasks)}
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            for future in list(pending):
+                i = futures[future]
+                if not future.done() and i in started and now - started[i] > self.tool_timeout:
+                    # the thread can't be stopped, but nobody waits for it any more
+                    outcomes[i] = f"Error: {tasks[i][0]} timed out after {self.tool_timeout} seconds"
+                    pending.discard(future)
+            deadlines = [started[futures[f]] + self.tool_timeout for f in pending if futures[f] in started]
+            # tasks still waiting for a worker don't have a deadline yet, so check back soon
+            timeout = max(min(deadlines) - now, 0) if deadlines else 0.01
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                pending.discard(future)
+                try:
+                    outcomes[i] = future.result()
+                except Exception as e:
+                    outcomes[i] = f"Error: {tasks[i][0]} failed with {type(e).__name__}: {e}"
+        pool.shutdown(wait=False)
+        return outcomes
+
+    def call_tools(self, tool_calls):
+        """Calls the tools concurrently and returns their results in the same order as `tool_calls`.
+
+        A tool function can have a `batch` attribute: a function taking a list of argument dicts and
+        returning a list of results (or exceptions, for calls that failed). All calls to such a tool in the same turn are then made with a
+        single call to `batch` (e.g. one Elasticsearch _msearch instead of one search per call).
+        """
+        blue = "\033[94m"
+        bold = "\033[1m"
+        clear_color = "\033[0m"
+
+        results = [None] * len(tool_calls)
+        # memo key -> index of the call that runs it, so a call repeated in the same turn runs once
+        first_in_turn = {}
+        # every task is (indices of the tool calls it answers, (name, function returning one result per index))
+        tasks = []
+        batches = {}
+        for i, tool_call in enumerate(tool_calls):
+            # Parse the function arguments. A malformed call or unknown tool only fails its own call, as a task that raises
+            try:
+                tool, function_args = parse_tool_call(tool_call, self.tool_lookup)
+            except ValueError as e:
+                def fail(error=e):
+                    raise error
+                tasks.append(([i], (tool_call.function.name, fail)))
+                continue
+            key = self.tool_memo.key(tool_call.function.name, function_args) if getattr(tool, "idempotent", True) else None
+            if key in first_in_turn:
+                results[i] = self.tool_memo.reference(tool_calls[first_in_turn[key]].id)
+            elif key is not None:
+                results[i] = self.tool_memo.get(key, self.messages)
+            if results[i] is not None:
+                print(f"\n{bold}{blue}Reusing tool result:{clear_color} {blue}{tool_call.function.name} with args: {function_args}{clear_color}")
+                continue
+            if key is not None:
+                first_in_turn[key] = i
+            print(f"\n{bold}{blue}Calling tool:{clear_color} {blue}{tool_call.function.name} with args: {function_args}{clear_color}")
+            if hasattr(tool, "batch"):
+                batches.setdefault(tool_call.function.name, []).append((i, function_args))
+            else:
+                tasks.append(([i], (tool_call.function.name, lambda tool=tool, args=function_args: [tool(**args)])))
+        for name, calls in batches.items():
+            batch = self.tool_lookup[name].batch
+            tasks.append(([i for i, _ in calls], (name, lambda batch=batch, calls=calls: batch([args for _, args in calls]))))
+
+        failed = set()
+        outcomes = self.run_tasks([task for _, task in tasks])
+        for (indices, (name, _)), outcome in zip(tasks, outcomes):
+            # an error message stands in for every call the task was answering
+            task_results = outcome if isinstance(outcome, list) else [outcome] * len(indices)
+            for i, result in zip(indices, task_results):
+                # batch functions return an exception for a call that failed
+                if not isinstance(outcome, list) or isinstance(result, Exception):
+                    failed.add(i)
+                if isinstance(result, Exception):
+                    result = f"Error: {name} failed with {type(result).__name__}: {result}"
+                results[i] = result
+        # failed calls aren't memoized, so they are tried again
+        for key, i in first_in_turn.items():
+            if i not in failed:
+                self.tool_memo.put(key, tool_calls[i].id, results[i])
+        return results
+
     def say(self, message):
         # Define color variables
         red = "\033[91m"
@@ -37,13 +406,18 @@ class Conversation:
         clear_color = "\033[0m"
 
         print(f"\n{bold}{red}User:{clear_color} {red}{message}{clear_color}")
-        self.messages.append(
+        if self.prefetch is not None:
+            self.prefetch(message)
+        self.append(
             {
                 "role": "user",
                 "content": message
             }
         )
-        response = self.get_response(self.messages)
+        turn = {"start": time.perf_counter(), "time_to_first_token": None, "generation_time": 0.0, "prompt_tokens": [], "compacted_tokens": 0,
+                "tool_rounds": 0, "tool_calls": 0, "tokens": 0, "budget_hit": None}
+        self.fit_context(turn)
+        response_message = self.next_message(self.messages, turn)
         # {
         #     "id": "chatcmpl-abc123",
         #     "object": "chat.completion",
@@ -75,26 +449,25 @@ class Conversation:
         #         "total_tokens": 35
         #     }
         # }
-        response_message = response.choices[0].message
         
         # Handle tool calls if present
         while response_message.tool_calls:
-            if response_message.content is not None:
+            if response_message.content is not None and not self.stream:
                 print(f"\n{bold}{green}Assistant (in tool call):{clear_color} {green}{response_message.content}{clear_color}")
             # Append the assistant's message requesting to use the tool
-            self.messages.append(response_message)
+            self.append(response_message)
             
-            # Process each tool call
-            for tool_call in response_message.tool_calls:
-                # Parse the function arguments
-                function_args = json.loads(tool_call.function.arguments)
-                
-                # Call the function and get the result
-                print(f"\n{bold}{blue}Calling tool:{clear_color} {blue}{tool_call.function.name} with args: {function_args}{clear_color}")
-                result = self.tool_lookup[tool_call.function.name](**function_args)
-                
+            # Process the tool calls the turn's budgets allow; every tool call still needs an answer
+            allowed, turn["budget_hit"] = self.tool_call_allowance(turn, len(response_message.tool_calls))
+            results = []
+            if allowed:
+                results = self.call_tools(response_message.tool_calls[:allowed])
+                turn["tool_rounds"] += 1
+                turn["tool_calls"] += allowed
+            results += [self.not_run_result(turn["budget_hit"]) for _ in response_message.tool_calls[allowed:]]
+            for tool_call, result in zip(response_message.tool_calls, results):
                 # Append the function response to messages
-                self.messages.append({
+                self.append({
                     "role": "tool",
                     "tool_call_id": tool_call.id,
                     "name": tool_call.function.name,
@@ -105,13 +478,29 @@ class Conversation:
                 print(f"\n{bold}{light_blue}Tool response:{clear_color} {light_blue}{result[:300]}\n...\n{result[-300:]}{clear_color}")
                 # print(f"\n{bold}{light_blue}Tool response:{clear_color} {light_blue}{result[:300]}{clear_color}")
             
-            # Get a new response from the assistant with the tool results
-            response = self.get_response(self.messages)
-            response_message = response.choices[0].message
+            # Get a new response from the assistant with the tool results, a final answer if a budget ran out
+            turn["budget_hit"] = turn["budget_hit"] or self.exhausted_budget(turn)
+            self.fit_context(turn)
+            response_message = self.next_message(self.messages, turn, "none" if turn["budget_hit"] else "auto")
+            if turn["budget_hit"] and response_message.tool_calls:
+                # a server that ignores tool_choice="none" would otherwise keep the loop going on "Not run" answers
+                response_message = response_message.model_copy(update={"tool_calls": None})
         
-        self.messages.append(response_message)
-        if response_message.content is not None:
+        self.append(response_message)
+        if self.stream:
+            timing = {"time_to_first_token": turn["time_to_first_token"], "generation_time": turn["generation_time"], "total_time": time.perf_counter() - turn["start"]}
+            self.timings.append(timing)
+            ttft = f"{timing['time_to_first_token']:.2f}s" if timing["time_to_first_token"] is not None else "-"
+            print(f"(first token {ttft}, generation {timing['generation_time']:.2f}s, turn {timing['total_time']:.2f}s)")
+        elif response_message.content is not None:
             print(f"\n{bold}{green}Assistant:{clear_color} {green}{response_message.content}{clear_color}")
+        if turn["budget_hit"]:
+            self.budget_hits.append({"budget": turn["budget_hit"], "tool_rounds": turn["tool_rounds"], "tool_calls": turn["tool_calls"], "tokens": turn["tokens"], "seconds": time.perf_counter() - turn["start"]})
+            print(f"(turn stopped by its {turn['budget_hit']} budget after {turn['tool_rounds']} tool rounds)")
+        if self.context is not None:
+            self.token_counts.append({"prompt_tokens": turn["prompt_tokens"], "compacted_tokens": turn["compacted_tokens"]})
+            print(f"(prompt tokens per call {turn['prompt_tokens']}, {turn['compacted_tokens']} compacted away)")
+        self.save()
         return response_message.content
 
 
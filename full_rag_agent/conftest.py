@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules here import each other as top-level modules, like they do when run as scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent))
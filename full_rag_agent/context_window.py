@@ -0,0 +1,120 @@
+"""Keeps a conversation's messages under a token budget.
+
+When the messages go over `max_tokens`, old tool results are replaced with short stubs, oldest first. If that
+isn't enough, the oldest turns are folded into a rolling summary (when a summarizer client is given) or dropped.
+The system prompt and the last `keep_recent_turns` turns are never touched.
+Tokens are counted locally with tiktoken, or estimated at 4 characters per token if it isn't installed.
+"""
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+summary_prefix = "Summary of the earlier conversation:\n"
+stub_prefix = "[Old "
+# rough per-message overhead of the chat format
+tokens_per_message = 4
+
+
+def message_dict(message):
+    """Messages are dicts, except assistant messages, which are the ChatCompletionMessage the API returned"""
+    return message if isinstance(message, dict) else message.model_dump(exclude_none=True)
+
+
+class TokenCounter:
+    def __init__(self, model="gpt-4.1"):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_text(self, text):
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message):
+        message = message_dict(message)
+        tokens = tokens_per_message + self.count_text(message.get("content") or "")
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self.count_text(tool_call["function"]["name"]) + self.count_text(tool_call["function"]["arguments"])
+        return tokens
+
+    def count(self, messages):
+        return sum(self.count_message(message) for message in messages)
+
+
+class ContextWindow:
+    def __init__(self, max_tokens=12000, keep_recent_turns=2, model="gpt-4.1", summary_client=None, summary_model="gpt-4.1-mini"):
+        self.max_tokens = max_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.counter = TokenCounter(model)
+        # with a summary_client (an OpenAI client) old turns are summarized instead of dropped
+        self.summary_client = summary_client
+        self.summary_model = summary_model
+
+    @staticmethod
+    def is_summary(message):
+        return isinstance(message, dict) and message["role"] == "system" and message["content"].startswith(summary_prefix)
+
+    def split(self, messages):
+        """Returns (system messages, old messages, recent messages), cutting only at user messages so tool calls keep their results"""
+        head = 0
+        while head < len(messages) and message_dict(messages[head])["role"] == "system":
+            head += 1
+        user_turns = [i for i in range(head, len(messages)) if message_dict(messages[i])["role"] == "user"]
+        cut = user_turns[-self.keep_recent_turns] if len(user_turns) >= self.keep_recent_turns else head
+        return messages[:head], messages[head:cut], messages[cut:]
+
+    def compact_tool_results(self, old, excess):
+        """Replaces old tool results with stubs, oldest first, until `excess` tokens are saved. Returns the tokens left to save"""
+        for i, message in enumerate(old):
+            if excess <= 0:
+                break
+            if not isinstance(message, dict) or message["role"] != "tool" or message["content"].startswith(stub_prefix):
+                continue
+            name = message.get("name", "tool")
+            stub = {**message, "content": f"{stub_prefix}{name} result removed to save space. Call {name} again if you need it.]"}
+            excess -= self.counter.count_message(message) - self.counter.count_message(stub)
+            old[i] = stub
+        return excess
+
+    def summarize(self, previous_summary, old):
+        lines = [previous_summary] if previous_summary else []
+        for message in map(message_dict, old):
+            if message.get("content"):
+                lines.append(f"{message['role']}: {message['content'][:500]}")
+            for tool_call in message.get("tool_calls") or []:
+                lines.append(f"{message['role']} called {tool_call['function']['name']}({tool_call['function']['arguments']})")
+        response = self.summary_client.chat.completions.create(
+            model=self.summary_model,
+            messages=[
+                {"role": "system", "content": "Summarize this conversation between a user and an assistant in a few sentences. Keep what the user wants, their constraints, and what the assistant's tools found."},
+                {"role": "user", "content": "\n".join(lines)},
+            ],
+            max_tokens=300,
+            temperature=0,
+        )
+        return response.choices[0].message.content
+
+    def fit(self, messages):
+        """Returns the messages, compacted to fit within max_tokens where possible"""
+        total = self.counter.count(messages)
+        if total <= self.max_tokens:
+            return messages
+        system, old, recent = self.split(messages)
+        old = list(old)
+        excess = self.compact_tool_results(old, total - self.max_tokens)
+        if excess > 0 and old:
+            previous_summary = None
+            if system and self.is_summary(system[-1]):
+                previous_summary = system[-1]["content"][len(summary_prefix):]
+                system = system[:-1]
+            if self.summary_client is not None:
+                system = system + [{"role": "system", "content": summary_prefix + self.summarize(previous_summary, old)}]
+            elif previous_summary is not None:
+                system = system + [{"role": "system", "content": summary_prefix + previous_summary}]
+            old = []
+        return system + old + recent
@@ -0,0 +1,128 @@
+"""Pluggable text embedders for the product_embedding field, plus an on-disk cache of embeddings.
+
+EMBEDDER picks the embedder:
+  hashing (default)                       feature hashing of words and character trigrams (each word hashed once), numpy, works offline
+  sentence-transformers:<model name>      a small CPU model, e.g. sentence-transformers:all-MiniLM-L6-v2 (needs sentence-transformers installed)
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+embedding_cache_path = Path(os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite"))
+token_pattern = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """Hashes words and character trigrams into a fixed number of signed buckets. No model, no network, deterministic"""
+    def __init__(self, dims=384):
+        self.dims = dims
+        self.name = f"hashing-{dims}"
+        # every word seen so far gets an id, and its hashed features (the word and its trigrams) are stored once in
+        # flat arrays: word id -> offsets[id]:offsets[id + 1] in buckets/signs. A catalog's vocabulary is small
+        self.word_ids = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.buckets = np.zeros(0, dtype=np.int64)
+        self.signs = np.zeros(0, dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def add_words(self, words):
+        """Hashes the features of words not seen before"""
+        with self.lock:
+            words = [w for w in dict.fromkeys(words) if w not in self.word_ids]
+            if not words:
+                return
+            features = [[w] + [w[i:i + 3] for i in range(max(1, len(w) - 2))] for w in words]
+            hashes = np.array([zlib.crc32(f.encode()) for fs in features for f in fs], dtype=np.int64)
+            self.buckets = np.concatenate([self.buckets, hashes % self.dims])
+            self.signs = np.concatenate([self.signs, np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)])
+            self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum([len(fs) for fs in features])])
+            # ids are published last, so other threads only see words whose features are stored
+            for w in words:
+                self.word_ids[w] = len(self.word_ids)
+
+    def embed(self, texts):
+        """Tokenizes in python, then gathers every word's features and sums them into the vectors in one bincount"""
+        words = [token_pattern.findall(text.lower()) for text in texts]
+        self.add_words([w for text_words in words for w in text_words if w not in self.word_ids])
+        ids = np.array([self.word_ids[w] for text_words in words for w in text_words], dtype=np.int64)
+        offsets, buckets, signs = self.offsets, self.buckets, self.signs
+        counts = offsets[ids + 1] - offsets[ids]
+        # index of every feature of every word: each word's range offsets[id]:offsets[id + 1], laid end to end
+        feature_index = np.arange(counts.sum()) + np.repeat(offsets[ids] - (np.cumsum(counts) - counts), counts)
+        rows = np.repeat(np.repeat(np.arange(len(texts)), [len(w) for w in words]), counts)
+        # a weighted bincount over (row, bucket) cells sums the signs like np.add.at would, only faster
+        cells = rows * self.dims + buckets[feature_index]
+        vectors = np.bincount(cells, weights=signs[feature_index], minlength=len(texts) * self.dims)
+        vectors = vectors.reshape(len(texts), self.dims).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dims = self.model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers-{model_name}"
+
+    def embed(self, texts):
+        return self.model.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+embedder = None
+
+def get_embedder():
+    """Returns the embedder picked by EMBEDDER, creating it on first use"""
+    global embedder
+    if embedder is None:
+        choice = os.getenv("EMBEDDER", "hashing")
+        if choice.startswith("sentence-transformers"):
+            _, _, model_name = choice.partition(":")
+            embedder = SentenceTransformerEmbedder(model_name or "all-MiniLM-L6-v2")
+        else:
+            embedder = HashingEmbedder()
+    return embedder
+
+
+class EmbeddingCache:
+    """SQLite table of embeddings keyed by a hash of the embedder name and the text, so unchanged products aren't embedded again"""
+    def __init__(self, path=embedding_cache_path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(embedder, text):
+        return hashlib.sha1(f"{embedder.name}\0{text}".encode()).hexdigest()
+
+    def embed(self, embedder, texts):
+        """Embeds `texts` in one batch, only running the embedder on texts it hasn't seen before"""
+        keys = [self.key(embedder, text) for text in texts]
+        found = {}
+        with self.lock:
+            # sqlite limits the number of parameters per statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                )
+                found.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            vectors = embedder.embed([texts[i] for i in missing])
+            with self.lock:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(keys[i], vector.astype(np.float32).tobytes()) for i, vector in zip(missing, vectors)],
+                )
+                self.connection.commit()
+            found.update({keys[i]: vector for i, vector in zip(missing, vectors)})
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, embedder.dims), dtype=np.float32)
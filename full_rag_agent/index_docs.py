@@ -1,69 +1,76 @@
 import json
 import os
 import time
-import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
 from pathlib import Path
 
 from elasticsearch import Elasticsearch
 
+from embeddings import EmbeddingCache, get_embedder
+
 # Create the client instance
 api_key = os.getenv("ES_LOCAL_API_KEY")
 es = Elasticsearch("http://localhost:9200", api_key=api_key)
 
 # Define mapping for the index
-mapping = {
-    "mappings": {
-        "properties": {
-            "product_id": {"type": "keyword"},
-            "product_name": {
-                "type": "text",
-                "analyzer": "english",
-                "fields": {
-                    "exact": {
-                        "type": "text",
-                        "analyzer": "standard"
+def index_mapping():
+    """Mapping for the index. A function so that importing this module doesn't load the embedder just for its dims"""
+    return {
+        "mappings": {
+            "properties": {
+                "product_id": {"type": "keyword"},
+                "product_name": {
+                    "type": "text",
+                    "analyzer": "english",
+                    "fields": {
+                        "exact": {
+                            "type": "text",
+                            "analyzer": "standard"
+                        }
                     }
-                }
-            },
-            "product_class": {"type": "keyword"},
-            "product_description": {
-                "type": "text",
-                "analyzer": "english",
-                "fields": {
-                    "exact": {
-                        "type": "text",
-                        "analyzer": "standard"
+                },
+                "product_class": {"type": "keyword"},
+                "product_description": {
+                    "type": "text",
+                    "analyzer": "english",
+                    "fields": {
+                        "exact": {
+                            "type": "text",
+                            "analyzer": "standard"
+                        }
                     }
-                }
-            },
-            "rating_count": {"type": "integer"},
-            "average_rating": {"type": "float"},
-            "availability": {"type": "keyword"},
+                },
+                "rating_count": {"type": "integer"},
+                "average_rating": {"type": "float"},
+                "availability": {"type": "keyword"},
+                "content_hash": {"type": "keyword", "index": False},
+                # filled by the embedder picked with EMBEDDER, see embeddings.py
+                "product_embedding": {
+                    "type": "dense_vector",
+                    "dims": get_embedder().dims,
+                    "index": True,
+                    "similarity": "cosine",
+                },
+            }
         }
     }
-}
 
-# Create the index with mapping
+# searches go through the `wands` alias, which points at the latest versioned index, e.g. wands-20250101120000
 index_name = "wands"
+warm_up_queries = ["sofa", "standing desk", "area rug", "bar stools", "coffee table", "queen bed", "floor lamp"]
+# extra queries (one per line) to precompute facets for, on top of the warm up queries and the most common product classes
+facet_queries_path = Path("./facet_queries.txt")
 
-if es.indices.exists(index=index_name):
-    es.indices.delete(index=index_name)
-es.indices.create(index=index_name, body=mapping)
-
+import numpy as np
 import pandas as pd
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import scan, streaming_bulk
 
-# Load product data
-product_df = pd.read_csv("./product.csv", sep='\t')
-product_df = product_df.rename(columns={"category hierarchy": "category_hierarchy"})
-
-product_df["rating_count"] = product_df["rating_count"].fillna(0)
-product_df["average_rating"] = product_df["average_rating"].fillna(0)
-product_df["review_count"] = product_df["review_count"].fillna(0)
-
-product_df["product_class"] = product_df["product_class"].fillna("")
-product_df["product_description"] = product_df["product_description"].fillna("")
-product_df["category_hierarchy"] = product_df["category_hierarchy"].fillna("")
+product_csv = "./product.csv"
+checkpoint_path = Path("./index_checkpoint.json")
 
 states = [
     "Alabama", "Alaska", "Arizona", "Arkansas", "California", "Colorado", 
@@ -76,39 +83,444 @@ states = [
     "South Dakota", "Tennessee", "Texas", "Utah", "Vermont", "Virginia", 
     "Washington", "West Virginia", "Wisconsin", "Wyoming"
 ]
+state_array = np.array(states, dtype=object)
+rng = np.random.default_rng()
+
+# Create a new versioned index with mapping
+def create_versioned_index(eager_global_ordinals=False):
+    """With `eager_global_ordinals`, the product_class ordinals the facet aggregation needs are built at refresh time instead of by the first search after it"""
+    versioned_index = f"{index_name}-{time.strftime('%Y%m%d%H%M%S')}"
+    body = index_mapping()
+    if eager_global_ordinals:
+        body["mappings"]["properties"]["product_class"]["eager_global_ordinals"] = True
+    es.indices.create(index=versioned_index, body=body)
+    return versioned_index
+
+def warm_index(index):
+    """Runs a few typical searches against `index` before it goes live so the first real searches don't pay for cold caches"""
+    from search_docs import high_level_search
+    for query in warm_up_queries:
+        high_level_search(query, index=index, use_cache=False)
+
+def facet_snapshot_queries(index, num_classes=200):
+    """The queries worth precomputing facets for: warm up queries, facet_queries.txt and the names of the most common product classes"""
+    queries = list(warm_up_queries)
+    if facet_queries_path.exists():
+        queries += [line.strip() for line in facet_queries_path.read_text().splitlines() if line.strip()]
+    top_classes = es.search(index=index, size=0, aggs={"product_class": {"terms": {"field": "product_class", "size": num_classes}}})
+    queries += [bucket["key"].lower() for bucket in top_classes["aggregations"]["product_class"]["buckets"] if bucket["key"]]
+    return queries
+
+def build_facet_snapshot(index, batch_size=50):
+    """Computes the product_class facets of common unfiltered queries and saves them for search_docs' FACET_MODE=snapshot"""
+    from search_docs import build_search_query, facet_snapshot, normalize_query
+
+    start = time.time()
+    queries = list(dict.fromkeys(normalize_query(q) for q in facet_snapshot_queries(index)))
+    facets = {}
+    for batch in batched(queries, batch_size):
+        searches = []
+        for query in batch:
+            searches.append({"index": index})
+            searches.append({**build_search_query(query, num_results=0), "_source": False})
+        for query, response in zip(batch, es.msearch(searches=searches)["responses"]):
+            if "error" not in response:
+                facets[query] = response["aggregations"]
+    tmp_path = facet_snapshot.path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"index": index, "facets": facets}))
+    tmp_path.replace(facet_snapshot.path)
+    print(f"Saved facets for {len(facets)} queries to {facet_snapshot.path} in {time.time() - start:.1f} seconds")
+
+def swap_alias(new_index):
+    """Atomically points the alias at `new_index`"""
+    actions = []
+    if es.indices.exists_alias(name=index_name):
+        for old_index in es.indices.get_alias(name=index_name):
+            actions.append({"remove": {"index": old_index, "alias": index_name}})
+    elif es.indices.exists(index=index_name):
+        # a concrete index from before we used aliases is removed in the same atomic step
+        actions.append({"remove_index": {"index": index_name}})
+    actions.append({"add": {"index": new_index, "alias": index_name}})
+    es.indices.update_aliases(actions=actions)
+
+def delete_old_versions(keep=1):
+    """Deletes all versioned indices except the one behind the alias and the `keep` most recent ones before it"""
+    live = set(es.indices.get_alias(name=index_name))
+    versions = sorted(es.indices.get(index=f"{index_name}-*"), reverse=True)
+    old_versions = [v for v in versions if v not in live][keep:]
+    for old_index in old_versions:
+        print(f"Deleting old index {old_index}")
+        es.indices.delete(index=old_index)
+
+def read_product_chunks(chunk_size=5000):
+    """Reads product.csv in chunks of `chunk_size` rows so memory stays flat no matter how big the catalog is"""
+    for chunk in pd.read_csv(product_csv, sep='\t', chunksize=chunk_size):
+        chunk = chunk.rename(columns={"category hierarchy": "category_hierarchy"})
+
+        chunk["rating_count"] = chunk["rating_count"].fillna(0).astype(float)
+        chunk["average_rating"] = chunk["average_rating"].fillna(0).astype(float)
+        chunk["review_count"] = chunk["review_count"].fillna(0).astype(float)
+
+        chunk["product_class"] = chunk["product_class"].fillna("")
+        chunk["product_description"] = chunk["product_description"].fillna("")
+        chunk["category_hierarchy"] = chunk["category_hierarchy"].fillna("")
+        yield chunk
+
+# every csv column except the randomly sampled availability goes into the content hash
+hash_columns = [
+    "product_id", "product_name", "product_class", "category_hierarchy", "product_description",
+    "product_features", "rating_count", "average_rating", "review_count",
+]
+
+def content_hashes(chunk):
+    """Hashes the csv content of every row in the chunk. Columns are compared as strings so the hash doesn't depend on the dtype pandas picked for this particular chunk"""
+    hashes = pd.util.hash_pandas_object(chunk[hash_columns].astype(str), index=False)
+    return [f"{h:016x}" for h in hashes.tolist()]
+
+def sample_availability(num_rows, k=45):
+    """Equivalent to calling random.sample(states, k) once per row, but done for the whole chunk at once"""
+    picks = np.argsort(rng.random((num_rows, len(states))), axis=1)[:, :k]
+    return state_array[picks].tolist()
+
+embedding_cache = None
+
+def embed_products(chunk):
+    """Embeds the name and description of every product in the chunk in one batch, reusing cached embeddings of unchanged text"""
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache()
+    texts = (chunk["product_name"].fillna("").astype(str) + ". " + chunk["product_description"]).tolist()
+    return embedding_cache.embed(get_embedder(), texts).tolist()
+
+def chunk_to_docs(chunk, with_embeddings=True):
+    """Builds the documents for a chunk column-wise instead of row by row"""
+    columns = {
+        "product_id": chunk["product_id"].tolist(), # TODO: should I remove this or make an alias?
+        "product_name": chunk["product_name"].tolist(),
+        "product_class": chunk["product_class"].str.split("|").tolist(),
+        "category_hierarchy": [[c] for c in chunk["category_hierarchy"].tolist()],
+        "product_description": chunk["product_description"].tolist(),
+        "product_features": chunk["product_features"].tolist(),
+        "rating_count": chunk["rating_count"].tolist(),
+        "average_rating": chunk["average_rating"].tolist(),
+        "review_count": chunk["review_count"].tolist(),
+        "availability": sample_availability(len(chunk)),
+        "content_hash": content_hashes(chunk),
+    }
+    if with_embeddings:
+        columns["product_embedding"] = embed_products(chunk)
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
 
 # Prepare documents for bulk indexing
-def doc_generator():
-    for i, row in product_df.iterrows():
-        doc = {
-            "product_id": row["product_id"], # TODO: should I remove this or make an alias?
-            "product_name": row["product_name"], 
-            "product_class": row["product_class"].split("|"),
-            "category_hierarchy": [row["category_hierarchy"]],
-            "product_description": row["product_description"],
-            "product_features": row["product_features"],
-            "rating_count": row["rating_count"],
-            "average_rating": row["average_rating"],
-            "review_count": row["review_count"],
-            "availability": random.sample(states, 45)
-        }
+def doc_generator(chunk_size=5000, index=index_name, start_row=0, retry_ids=()):
+    """Yields index actions for every csv row from `start_row` on, plus the earlier rows whose product_id is in `retry_ids`"""
+    retry_ids = list(retry_ids)
+    for chunk in read_product_chunks(chunk_size):
+        # pandas keeps numbering rows across chunks, so the index is the row's position in the csv
+        if start_row or retry_ids:
+            chunk = chunk[(chunk.index >= start_row) | chunk["product_id"].astype(str).isin(retry_ids)]
+        for row, doc in zip(chunk.index.tolist(), chunk_to_docs(chunk)):
+            yield {
+                "_index": index,
+                "_id": doc["product_id"],
+                "_source": doc,
+                # not sent to elasticsearch, only used to checkpoint progress
+                "_row": row,
+            }
+
+def existing_content_hashes():
+    """Returns {product_id: content_hash} for everything currently in the index"""
+    return {
+        hit["_id"]: hit["_source"].get("content_hash")
+        for hit in scan(es, index=index_name, query={"query": {"match_all": {}}}, _source=["content_hash"], size=5000)
+    }
+
+def delta_generator(existing, stats, chunk_size=5000):
+    """Yields index actions for new and changed products, then delete actions for products that are no longer in the csv.
+
+    Rows are compared by content hash first, and documents (availability, embeddings) are only built for the ones that changed.
+    """
+    seen = set()
+    for chunk in read_product_chunks(chunk_size):
+        doc_ids = chunk["product_id"].astype(str).tolist()
+        seen.update(doc_ids)
+        changed = [existing.get(doc_id) != new_hash for doc_id, new_hash in zip(doc_ids, content_hashes(chunk))]
+        stats["unchanged"] += changed.count(False)
+        chunk = chunk[changed]
+        if chunk.empty:
+            continue
+        for doc in chunk_to_docs(chunk):
+            doc_id = str(doc["product_id"])
+            stats["changed" if doc_id in existing else "new"] += 1
+            yield {
+                "_index": index_name,
+                "_id": doc_id,
+                "_source": doc
+            }
+    for doc_id in existing.keys() - seen:
+        stats["deleted"] += 1
         yield {
+            "_op_type": "delete",
             "_index": index_name,
-            "_id": row["product_id"],
-            "_source": doc
+            "_id": doc_id,
         }
 
-def index_docs():
+def failure_info(item):
+    """Returns (doc_id, error_type, reason) for a failed item reported by streaming_bulk"""
+    info = next(iter(item.values()))
+    error = info.get("error", info.get("exception"))
+    if isinstance(error, dict):
+        return str(info.get("_id")), error.get("type", "unknown"), error.get("reason")
+    return str(info.get("_id")), f"status {info.get('status')}", str(error)
+
+def print_failure_summary(failed):
+    """Prints how many documents failed with each error type, along with an example reason"""
+    counts = Counter()
+    examples = {}
+    for item in failed:
+        doc_id, error_type, reason = failure_info(item)
+        counts[error_type] += 1
+        examples.setdefault(error_type, f"{doc_id}: {reason}")
+    print(f"Failed to index {len(failed)} documents")
+    for error_type, count in counts.most_common():
+        print(f"  {error_type}: {count} (e.g. {examples[error_type]})")
+
+class Checkpoint:
+    """Progress of a full index run, written to disk after every bulk chunk so a run that dies can be resumed
+
+    `rows_committed` only moves past a chunk once every chunk before it has finished too, so
+    everything before it is known to be indexed, except for the documents listed in `failed_ids`.
+    """
+    def __init__(self, index, rows_committed=0, failed_ids=(), original_settings=None, path=checkpoint_path):
+        self.index = index
+        self.rows_committed = rows_committed
+        self.failed_ids = set(failed_ids)
+        self.original_settings = original_settings
+        self.path = path
+        self.next_chunk = 0
+        self.finished_chunks = {}
+
+    @classmethod
+    def load(cls, path=checkpoint_path):
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        return cls(data["index"], data["rows_committed"], data["failed_ids"], data["original_settings"], path)
+
+    def save(self):
+        data = {
+            "index": self.index,
+            "rows_committed": self.rows_committed,
+            "failed_ids": sorted(self.failed_ids),
+            "original_settings": self.original_settings,
+        }
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, indent=2))
+        tmp_path.replace(self.path)
+
+    def delete(self):
+        self.path.unlink(missing_ok=True)
+
+    def chunk_done(self, chunk_number, actions, failed):
+        """Called with every chunk once bulk_load is done with it, in whatever order the chunks finish"""
+        failed_ids = {failure_info(item)[0] for item in failed}
+        self.failed_ids -= {str(action["_id"]) for action in actions}
+        self.failed_ids |= failed_ids
+
+        self.finished_chunks[chunk_number] = max(action["_row"] for action in actions) + 1
+        while self.next_chunk in self.finished_chunks:
+            self.rows_committed = max(self.rows_committed, self.finished_chunks.pop(self.next_chunk))
+            self.next_chunk += 1
+        self.save()
+
+@contextmanager
+def bulk_load_settings(index, original=None):
+    """Turns off refresh and replicas while `index` is being loaded and restores the original settings afterwards
+
+    Yields the original settings, pass them back in as `original` when resuming a load that died
+    before they could be restored.
+    """
+    if original is None:
+        current = es.indices.get_settings(index=index, flat_settings=True)
+        # a setting that was never set explicitly comes back as None, which resets it to the default on restore
+        original = {
+            name: {
+                "index.refresh_interval": data["settings"].get("index.refresh_interval"),
+                "index.number_of_replicas": data["settings"].get("index.number_of_replicas"),
+            }
+            for name, data in current.items()
+        }
+    es.indices.put_settings(index=index, settings={"index.refresh_interval": "-1", "index.number_of_replicas": 0})
+    try:
+        yield original
+    finally:
+        for name, settings in original.items():
+            es.indices.put_settings(index=name, settings=settings)
+        es.indices.refresh(index=index)
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+def load_chunk(chunk_number, actions, max_chunk_bytes, max_retries, initial_backoff, max_backoff):
+    """Sends one chunk of actions, backing off and retrying documents rejected with a 429, and reports its throughput"""
+    start = time.time()
+    success = 0
+    failed = []
+    for ok, item in streaming_bulk(
+        es,
+        actions,
+        chunk_size=len(actions),
+        max_chunk_bytes=max_chunk_bytes,
+        max_retries=max_retries,
+        initial_backoff=initial_backoff,
+        max_backoff=max_backoff,
+        raise_on_error=False,
+    ):
+        if ok:
+            success += 1
+        else:
+            failed.append(item)
+    elapsed = time.time() - start
+    print(f"Chunk {chunk_number}: {success} docs in {elapsed:.2f} seconds ({success / elapsed:.0f} docs/sec), {len(failed)} failed")
+    return success, failed
+
+def bulk_load(
+        actions,
+        workers=1,
+        chunk_size=500,
+        max_chunk_bytes=10 * 1024 * 1024,
+        max_retries=5,
+        initial_backoff=2,
+        max_backoff=60,
+        on_chunk_done=None,
+    ):
+    """Bulk loads `actions` with `workers` threads each sending `chunk_size` documents (at most `max_chunk_bytes`) per request
+
+    `on_chunk_done(chunk_number, actions, failed)` is called from this thread as each chunk finishes.
+    """
+    success = 0
+    failed = []
+    def collect(futures):
+        nonlocal success
+        for future in futures:
+            chunk_number, chunk = pending_chunks.pop(future)
+            chunk_success, chunk_failed = future.result()
+            success += chunk_success
+            failed.extend(chunk_failed)
+            if on_chunk_done:
+                on_chunk_done(chunk_number, chunk, chunk_failed)
+
+    pending_chunks = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for chunk_number, chunk in enumerate(batched(actions, chunk_size)):
+            # only keep a couple of chunks per worker in flight so memory stays bounded
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(load_chunk, chunk_number, chunk, max_chunk_bytes, max_retries, initial_backoff, max_backoff)
+            pending_chunks[future] = (chunk_number, chunk)
+            pending.add(future)
+        collect(pending)
+    return success, failed
+
+def index_docs(csv_chunk_size=5000, keep_old_versions=1, resume=False, eager_global_ordinals=False, **bulk_options):
+    """Builds a new versioned index next to the live one, warms it, swaps the alias over and deletes old versions
+
+    Progress is checkpointed to index_checkpoint.json. With `resume`, a previous run that died (or
+    had failures) is picked up where it left off and only its failed documents are retried.
+    """
+    checkpoint = Checkpoint.load() if resume else None
+    if checkpoint and not es.indices.exists(index=checkpoint.index):
+        print(f"Checkpointed index {checkpoint.index} no longer exists, starting over")
+        checkpoint = None
+    if checkpoint:
+        print(f"Resuming {checkpoint.index} from row {checkpoint.rows_committed}, retrying {len(checkpoint.failed_ids)} failed documents")
+    else:
+        checkpoint = Checkpoint(create_versioned_index(eager_global_ordinals))
+        checkpoint.save()
+        print(f"Building {checkpoint.index}")
+    new_index = checkpoint.index
+
     start = time.time()
-    success, failed = bulk(es, doc_generator(), raise_on_error=False)
+    actions = doc_generator(csv_chunk_size, new_index, checkpoint.rows_committed, checkpoint.failed_ids)
+    already_live = es.indices.exists_alias(name=index_name, index=new_index)
+    if already_live:
+        # only retrying failures of a run that already went live, so leave refresh and replicas alone
+        success, failed = bulk_load(actions, on_chunk_done=checkpoint.chunk_done, **bulk_options)
+    else:
+        with bulk_load_settings(new_index, checkpoint.original_settings) as original_settings:
+            checkpoint.original_settings = original_settings
+            checkpoint.save()
+            success, failed = bulk_load(actions, on_chunk_done=checkpoint.chunk_done, **bulk_options)
+    elapsed = time.time() - start
     print(f"Successfully indexed {success} documents")
     if failed:
-        print(f"Failed to index {len(failed)} documents")
-        print(f"Time taken: {time.time() - start} seconds")
+        print_failure_summary(failed)
+    print(f"Time taken: {elapsed:.1f} seconds ({success / elapsed:.0f} docs/sec)")
 
-if __name__ == "__main__":
-    index_docs()
+    if not already_live:
+        warm_index(new_index)
+        build_facet_snapshot(new_index)
+        swap_alias(new_index)
+        print(f"Alias {index_name} now points at {new_index}")
+        delete_old_versions(keep_old_versions)
+
+    if checkpoint.failed_ids:
+        print(f"{len(checkpoint.failed_ids)} documents still failing, run again with --resume to retry them")
+    else:
+        checkpoint.delete()
+
+def incremental_index_docs(csv_chunk_size=5000, **bulk_options):
+    """Only sends products whose content hash changed since the last run and deletes products that were removed from the csv"""
+    if not es.indices.exists(index=index_name):
+        print(f"Index {index_name} does not exist yet, doing a full index")
+        return index_docs(csv_chunk_size, **bulk_options)
+
+    # reads and writes go through the alias to whichever versioned index is live
+    start = time.time()
+    existing = existing_content_hashes()
+    stats = {"new": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+    success, failed = bulk_load(delta_generator(existing, stats, csv_chunk_size), **bulk_options)
     es.indices.refresh(index=index_name)
+    # keyed on the concrete index behind the alias, like the search cache
+    build_facet_snapshot(next(iter(es.indices.get(index=index_name))))
+    print(f"New: {stats['new']}, changed: {stats['changed']}, unchanged: {stats['unchanged']}, deleted: {stats['deleted']}")
+    print(f"Successfully applied {success} changes")
+    if failed:
+        print_failure_summary(failed)
+    print(f"Time taken: {time.time() - start:.1f} seconds")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index product.csv into the wands index")
+    parser.add_argument("--incremental", action="store_true", help="Only upsert new or changed products and delete removed ones instead of rebuilding the index")
+    parser.add_argument("--resume", action="store_true", help="Pick up a full reindex that died (or had failures) from index_checkpoint.json")
+    parser.add_argument("--keep-old-versions", type=int, default=1, help="Number of previous versioned indices to keep around for rollback after a full reindex")
+    parser.add_argument("--eager-global-ordinals", action="store_true", help="Build product_class global ordinals at refresh time so facet aggregations don't pay for them")
+    parser.add_argument("--csv-chunk-size", type=int, default=5000, help="Number of csv rows read and converted to documents at a time")
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads sending bulk requests in parallel")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Number of documents per bulk request")
+    parser.add_argument("--max-chunk-bytes", type=int, default=10 * 1024 * 1024, help="Maximum size of a bulk request in bytes")
+    parser.add_argument("--max-retries", type=int, default=5, help="Number of times documents rejected with a 429 are retried")
+    parser.add_argument("--initial-backoff", type=float, default=2, help="Seconds to wait before the first retry, doubled on every retry")
+    parser.add_argument("--max-backoff", type=float, default=60, help="Maximum number of seconds to wait between retries")
+    args = parser.parse_args()
+
+    bulk_options = dict(
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        max_chunk_bytes=args.max_chunk_bytes,
+        max_retries=args.max_retries,
+        initial_backoff=args.initial_backoff,
+        max_backoff=args.max_backoff,
+    )
+    if args.incremental:
+        incremental_index_docs(csv_chunk_size=args.csv_chunk_size, **bulk_options)
+    else:
+        index_docs(csv_chunk_size=args.csv_chunk_size, keep_old_versions=args.keep_old_versions, resume=args.resume, eager_global_ordinals=args.eager_global_ordinals, **bulk_options)
 
     # Search query
     search_query = {
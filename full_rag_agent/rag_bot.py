@@ -1,62 +1,144 @@
+import os
+import sys
+from pathlib import Path
+
+if __name__ == "__main__":
+    # run as a script: llm_utils lives at the repo root, which isn't on the path yet
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from chat_bot import Conversation
-from search_docs import high_level_search, format_results_for_toolcall
+from context_window import ContextWindow
+from session_store import SessionStore
+from search_docs import high_level_search, high_level_search_many, async_high_level_search, async_high_level_search_many, format_results_for_toolcall, format_results_within_budget, search_cache, SearchError, SearchPrefetcher
+
+# search results are trimmed to about this many tokens per search, 0 sends them whole
+tool_output_token_budget = int(os.getenv("TOOL_OUTPUT_TOKEN_BUDGET", "1200"))
+tool_output_tokens = []
+
+def format_search_results(results):
+    if not tool_output_token_budget:
+        return format_results_for_toolcall(results)
+    text, tokens = format_results_within_budget(results, tool_output_token_budget)
+    tool_output_tokens.append(tokens)
+    return text
+
+
+# the user's message is searched for while the model plans its searches, PREFETCH_SEARCH=0 turns that off
+prefetch_search = os.getenv("PREFETCH_SEARCH", "1") != "0"
+search_prefetcher = SearchPrefetcher(lambda query_string: high_level_search(query_string, compact=True, hybrid=True))
+
+# the tools spell out their arguments so Conversation.call_tools can reject a bad call before it joins a batch
+def search_catalog(query_string, availability=None, product_class=None, min_average_rating=None, num_results=10):
+    kwargs = dict(query_string=query_string, availability=availability, product_class=product_class, min_average_rating=min_average_rating, num_results=num_results)
+    results = search_prefetcher.get(kwargs)
+    if results is None:
+        results = high_level_search(compact=True, hybrid=True, **kwargs)
+    return format_search_results(results)
+
+def search_catalog_batch(list_of_kwargs):
+    """Same-turn search_catalog calls go to Elasticsearch in a single _msearch. A failed search is returned as its SearchError"""
+    results = [search_prefetcher.get(kwargs) for kwargs in list_of_kwargs]
+    to_search = [i for i, prefetched in enumerate(results) if prefetched is None]
+    if to_search:
+        for i, searched in zip(to_search, high_level_search_many([list_of_kwargs[i] for i in to_search], compact=True, hybrid=True)):
+            results[i] = searched
+    return [
+        result if isinstance(result, SearchError) else format_search_results(result)
+        for result in results
+    ]
+
+search_catalog.batch = search_catalog_batch
+
+
+async def async_search_catalog(query_string, availability=None, product_class=None, min_average_rating=None, num_results=10):
+    return format_search_results(await async_high_level_search(
+        query_string, availability, product_class, min_average_rating, num_results, compact=True, hybrid=True,
+    ))
+
+async def async_search_catalog_batch(list_of_kwargs):
+    return [
+        results if isinstance(results, SearchError) else format_search_results(results)
+        for results in await async_high_level_search_many(list_of_kwargs, compact=True, hybrid=True)
+    ]
+
+async_search_catalog.batch = async_search_catalog_batch
 
         
-def main():
-    tools = [{
-        "type": "function",
-        "function": {
-            "name": "search_catalog",
-            "description": "Search for products in the catalog using various filters. Sometimes the results will be an imperfect match for the query. If you feel that the results can be improved, you should refine the query by adding a product_class filter or by modifying the query string to use different search terms.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query_string": {
-                        "type": "string",
-                        "description": "The search query to match against product names and descriptions"
-                    },
-                    "product_class": {
-                        "type": "string",
-                        "description": "Filter results by product class. It is important to use exact string matches from the product_class list, so only use this after making a preliminary query_string-only search and reviewing the product_class facet.",
-                        "optional": True
-                    },
-                    "min_average_rating": {
-                        "type": "number",
-                        "description": "Filter results by minimum average rating - this should be a number between 0 and 5",
-                        "optional": True
-                    },
+tools = [{
+    "type": "function",
+    "function": {
+        "name": "search_catalog",
+        "description": "Search for products in the catalog using various filters. Sometimes the results will be an imperfect match for the query. If you feel that the results can be improved, you should refine the query by adding a product_class filter or by modifying the query string to use different search terms.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query_string": {
+                    "type": "string",
+                    "description": "The search query to match against product names and descriptions"
+                },
+                "product_class": {
+                    "type": "string",
+                    "description": "Filter results by product class. It is important to use exact string matches from the product_class list, so only use this after making a preliminary query_string-only search and reviewing the product_class facet.",
+                    "optional": True
                 },
-                "required": ["query_string"]
-            }
+                "min_average_rating": {
+                    "type": "number",
+                    "description": "Filter results by minimum average rating - this should be a number between 0 and 5",
+                    "optional": True
+                },
+            },
+            "required": ["query_string"]
         }
-    }]
-
-    tool_lookup = {
-        "search_catalog": lambda **x: format_results_for_toolcall(high_level_search(**x))
     }
+}]
+
+tool_lookup = {
+    "search_catalog": search_catalog
+}
 
-    model = "gpt-4.1"
+# for serving with async_chat_bot.AsyncConversation
+async_tool_lookup = {
+    "search_catalog": async_search_catalog
+}
 
-    system = """You are a helpful assistant that can the user find products from the catalog of furniture, home décor, bedding & bath, and kitchen & dining.
+model = "gpt-4.1"
 
-    The user will discuss what they are looking for and it is your job to research the catalog and find the best matches.
+system = """You are a helpful assistant that can the user find products from the catalog of furniture, home décor, bedding & bath, and kitchen & dining.
 
-    When it's unclear what the user is looking for, you should ask them for more information.
+The user will discuss what they are looking for and it is your job to research the catalog and find the best matches.
 
-    When you have an idea of what the user is looking for, you should make parallel searches covering different interpretations of the user's request and different wordings of the same request.
+When it's unclear what the user is looking for, you should ask them for more information.
 
-    When you see the results, make one more round of clarifying searches based upon the results you've found to this point.
+When you have an idea of what the user is looking for, you should make parallel searches covering different interpretations of the user's request and different wordings of the same request.
 
-    Finally, report back to the user about all that you've discovered.
-    """
+When you see the results, make one more round of clarifying searches based upon the results you've found to this point.
 
-    c = Conversation(model, tools, tool_lookup, system)
+Finally, report back to the user about all that you've discovered.
+"""
+
+
+# per-turn limits that stop a runaway chain of searches, see Conversation
+turn_budgets = dict(max_tool_rounds=4, max_tool_calls=16, turn_timeout=45)
+
+
+def main():
+    # `python rag_bot.py <session id>` resumes a saved session
+    session_id = sys.argv[1] if len(sys.argv) > 1 else None
+    c = Conversation(model, tools, tool_lookup, system, stream=True, context=ContextWindow(model=model),
+                     prefetch=search_prefetcher.start if prefetch_search else None, store=SessionStore(), session_id=session_id,
+                     **turn_budgets)
+    print(f"Session {c.session_id}, {len(c.messages)} messages")
     
     print("Hint: Try to get the assistant to exercist all the arguments of the search_catalog function: query_string, product_class, min_average_rating")
 
     while True:
         user_input = input("\nYou: ")
         if user_input.lower() in ['exit', 'quit']:
+            print(f"Search cache: {search_cache.stats()}")
+            print(f"LLM calls: {c.llm.stats()}")
+            if prefetch_search:
+                print(f"Search prefetch: {search_prefetcher.stats()}")
+            if tool_output_tokens:
+                print(f"Search results: {len(tool_output_tokens)} sent, {sum(tool_output_tokens) / len(tool_output_tokens):.0f} tokens on average")
             break
         c.say(user_input)
 
@@ -1,19 +1,337 @@
+import asyncio
+import copy
+import json
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch, Elasticsearch, NotFoundError
 from pathlib import Path
 
+import bm25_search
+from context_window import TokenCounter
+from embeddings import get_embedder
+
 # Create the client instance
 api_key = os.getenv("ES_LOCAL_API_KEY")
 es = Elasticsearch("http://localhost:9200", api_key=api_key)
+# The async client is created on first use by get_async_es() and shared by all coroutines
+async_es = None
+# SEARCH_BACKEND=bm25 answers searches in-process from bm25_search.py instead of elasticsearch
+search_backend = os.getenv("SEARCH_BACKEND", "elasticsearch")
+# `wands` is an alias that index_docs.py swaps over to each freshly built index, so searches never see a half built index
 index_name = "wands"
+# how much of the product description the formatters show, compact searches truncate it server side
+description_max_chars = 750
+# the only fields format_hit_for_human uses, compact searches don't ask for anything else
+compact_source_fields = ["product_id", "product_name", "product_class", "average_rating"]
+# hybrid searches fetch this many hits from both the lexical and the knn side before fusing them
+rank_window_size = 20
+rank_constant = 60
+compact_filter_path = [
+    "hits.total", "hits.max_score", "hits.hits._id", "hits.hits._score", "hits.hits._source", "hits.hits.fields", "aggregations",
+]
 
-def high_level_search(
-        query_string, 
-        availability=None, 
-        product_class=None, 
-        min_average_rating=None, 
+
+class IndexAlias:
+    """Tracks the concrete index behind the `wands` alias (the index version), looking it up at most every `check_interval` seconds.
+
+    Shared by the search cache and the facet snapshot, which both have to notice a blue/green reindex.
+    """
+    def __init__(self, check_interval=30):
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0
+
+    def check_due(self):
+        return time.time() - self.checked_at >= self.check_interval
+
+    @staticmethod
+    def parse(aliases):
+        return ",".join(sorted(aliases))
+
+    def check(self):
+        """Returns the index version, looking it up again if it's due"""
+        if self.check_due():
+            self.checked_at = time.time()
+            try:
+                self.version = self.parse(es.indices.get_alias(name=index_name))
+            except NotFoundError:
+                # a plain index from before index_docs.py used aliases
+                self.version = index_name
+        return self.version
+
+    async def async_check(self):
+        """Same as check, but doesn't block the event loop"""
+        if self.check_due():
+            self.checked_at = time.time()
+            try:
+                self.version = self.parse(await get_async_es().indices.get_alias(name=index_name))
+            except NotFoundError:
+                self.version = index_name
+        return self.version
+
+
+index_alias = IndexAlias()
+
+
+class SearchCache:
+    """LRU cache of search results. Entries expire after `ttl` seconds and everything is dropped when the index version changes.
+
+    The index version is the concrete index behind the `wands` alias (see IndexAlias), so a blue/green reindex
+    invalidates the cache.
+    """
+    def __init__(self, max_size=1000, ttl=300, alias=index_alias):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.alias = alias
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.index_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def check_index_version(self):
+        self.invalidate(self.alias.check())
+
+    async def async_check_index_version(self):
+        """Same as check_index_version, but doesn't block the event loop"""
+        self.invalidate(await self.alias.async_check())
+
+    def invalidate(self, index_version=None):
+        """Drops every entry. If `index_version` is given, only drops them when it differs from the current version"""
+        with self.lock:
+            if index_version is not None and index_version == self.index_version:
+                return
+            self.index_version = index_version
+            self.entries.clear()
+
+    def get(self, key, check_version=True):
+        if check_version:
+            self.check_index_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        # callers are free to modify the results they get back
+        return copy.deepcopy(entry[1])
+
+    def put(self, key, results):
+        results = copy.deepcopy(results)
+        with self.lock:
+            self.entries[key] = (time.time(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "index_version": self.index_version,
+            }
+
+
+# SEARCH_CACHE_SIZE=0 turns the cache off
+search_cache = SearchCache(
+    max_size=int(os.getenv("SEARCH_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", "300")),
+)
+
+def normalize_query(query_string):
+    return " ".join(query_string.lower().split())
+
+def search_cache_key(query_string, availability, product_class, min_average_rating, num_results, index, compact=False, hybrid=False):
+    """Normalizes the search arguments so trivially different calls (case, whitespace, 4 vs 4.0) share a cache entry"""
+    return (
+        normalize_query(query_string),
+        availability or None,
+        product_class.strip() if product_class else None,
+        float(min_average_rating) if min_average_rating else None,
+        int(num_results),
+        index,
+        bool(compact),
+        bool(hybrid),
+    )
+
+# words of a chat message that a search query wouldn't have
+filler_words = {
+    "i", "im", "me", "my", "we", "our", "you", "your", "what", "which", "do", "does", "have", "has", "need", "want",
+    "looking", "look", "find", "show", "get", "can", "could", "would", "please", "some", "any", "something", "like", "hi", "hello",
+}
+
+class SearchPrefetcher:
+    """Starts a search on the user's own words while the model is still deciding what to search for.
+
+    A later search with no filters whose query shares at least `threshold` of its words (stemmed, stopwords and
+    chat filler dropped) with a prefetched query gets the prefetched results. A prefetch that is already running is
+    waited for up to `max_wait` seconds; one still queued behind other prefetches isn't, the search just runs itself.
+    Messages with fewer than `min_words` such words ("thanks", "ok") aren't prefetched.
+    """
+    def __init__(self, search, threshold=0.6, max_size=64, ttl=60, max_workers=4, max_wait=1.0, min_words=2):
+        # search(query_string) -> results
+        self.search = search
+        self.threshold = threshold
+        self.max_wait = max_wait
+        self.min_words = min_words
+        self.max_size = max_size
+        self.ttl = ttl
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # normalized query -> (start time, query words, future)
+        self.prefetches = OrderedDict()
+        self.used = set()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.prefetches_used = 0
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def query_words(query_string):
+        tokens = bm25_search.standard_tokens(query_string)
+        return frozenset(bm25_search.stem(t) for t in tokens if t not in bm25_search.stopwords and t not in filler_words)
+
+    def start(self, query_string):
+        words = self.query_words(query_string)
+        if len(words) < self.min_words:
+            return
+        key = normalize_query(query_string)
+        with self.lock:
+            if key in self.prefetches:
+                return
+            self.prefetches[key] = (time.time(), words, self.pool.submit(self.search, query_string))
+            self.started += 1
+            while len(self.prefetches) > self.max_size:
+                self.used.discard(self.prefetches.popitem(last=False)[0])
+
+    def get(self, kwargs):
+        """The prefetched results for a search with these high_level_search arguments, or None"""
+        if any(kwargs.get(name) for name in ("availability", "product_class", "min_average_rating")) or kwargs.get("num_results", 10) != 10:
+            return None
+        # a call missing its query is left to the normal search path, which reports the error for that call alone
+        if not isinstance(kwargs.get("query_string"), str):
+            return None
+        words = self.query_words(kwargs["query_string"])
+        with self.lock:
+            self.lookups += 1
+            best, best_similarity = None, self.threshold
+            for key, (started_at, prefetched_words, future) in self.prefetches.items():
+                similarity = len(words & prefetched_words) / len(words | prefetched_words) if words else 0.0
+                if time.time() - started_at <= self.ttl and similarity >= best_similarity:
+                    best, best_similarity = (key, future), similarity
+        if best is None:
+            return None
+        key, future = best
+        if not (future.running() or future.done()):
+            return None
+        try:
+            results = future.result(timeout=self.max_wait)
+        except TimeoutError:
+            return None
+        except Exception:
+            # the search itself will raise again, with the model's arguments
+            return None
+        with self.lock:
+            self.hits += 1
+            if key in self.prefetches and key not in self.used:
+                self.used.add(key)
+                self.prefetches_used += 1
+        # callers are free to modify the results they get back
+        return copy.deepcopy(results)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "prefetches": self.started,
+                "used": self.prefetches_used,
+                "hit_rate": self.prefetches_used / self.started if self.started else 0.0,
+                "searches": self.lookups,
+                "served": self.hits,
+            }
+
+
+class FacetSnapshot:
+    """product_class facets for common unfiltered queries, computed by index_docs.py at index time.
+
+    The file is reloaded whenever index_docs.py rewrites it, and ignored when it was computed for a
+    different index than the one the alias points at, whether or not the search cache is on.
+    """
+    def __init__(self, path, alias=index_alias):
+        self.path = path
+        self.mtime = None
+        self.index = None
+        self.facets = {}
+        self.alias = alias
+        self.index_version = None
+
+    def check_index_version(self):
+        self.index_version = self.alias.check()
+
+    async def async_check_index_version(self):
+        """Same as check_index_version, but doesn't block the event loop"""
+        self.index_version = await self.alias.async_check()
+
+    def reload_if_changed(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            self.mtime, self.index, self.facets = None, None, {}
+            return
+        if mtime != self.mtime:
+            snapshot = json.loads(self.path.read_text())
+            self.mtime, self.index, self.facets = mtime, snapshot["index"], snapshot["facets"]
+
+    def get(self, query_string, check_version=True):
+        self.reload_if_changed()
+        if not self.facets:
+            return None
+        if check_version:
+            self.check_index_version()
+        if self.index != self.index_version:
+            return None
+        facets = self.facets.get(normalize_query(query_string))
+        return copy.deepcopy(facets) if facets is not None else None
+
+
+# FACET_MODE=snapshot answers facets of common queries from facet_snapshot.json instead of aggregating live
+facet_mode = os.getenv("FACET_MODE", "live")
+facet_snapshot = FacetSnapshot(Path(os.getenv("FACET_SNAPSHOT_PATH", "./facet_snapshot.json")))
+
+def use_facet_snapshot(search_query, query_string, availability=None, product_class=None, min_average_rating=None, index=index_name, check_version=True, **kwargs):
+    """In snapshot facet mode, drops the aggregation from `search_query` when the snapshot has it. Returns the snapshot facets, or None"""
+    if facet_mode != "snapshot" or availability or product_class or min_average_rating or index != index_name:
+        return None
+    facets = facet_snapshot.get(query_string, check_version)
+    if facets is not None:
+        del search_query["aggs"]
+    return facets
+
+def build_search_query(
+        query_string,
+        availability=None,
+        product_class=None,
+        min_average_rating=None,
         num_results=10,
+        compact=False,
     ):
     search_query = {
         "query": {
@@ -89,11 +407,290 @@ def high_level_search(
         )
 
     search_query["size"] = num_results
-    results = es.search(index=index_name, body=search_query)
+    # embeddings are only for knn, never worth shipping back
+    search_query["_source"] = {"excludes": ["product_embedding"]}
+    if compact:
+        # only ship the fields the formatters use, and cut the description down before it leaves elasticsearch
+        search_query["_source"] = compact_source_fields
+        search_query["script_fields"] = {
+            "product_description": {
+                "script": {
+                    "source": "def d = params._source.product_description; return d == null || d.length() <= params.max_chars ? d : d.substring(0, params.max_chars)",
+                    "params": {"max_chars": description_max_chars},
+                }
+            }
+        }
+    return search_query
+
+def build_knn_query(
+        query_string,
+        availability=None,
+        product_class=None,
+        min_average_rating=None,
+        num_results=10,
+        compact=False,
+    ):
+    """kNN search on product_embedding with the same filters and returned fields as build_search_query"""
+    lexical_query = build_search_query(query_string, availability, product_class, min_average_rating, num_results, compact)
+    knn_query = {
+        "knn": {
+            "field": "product_embedding",
+            "query_vector": get_embedder().embed([query_string])[0].tolist(),
+            "k": num_results,
+            "num_candidates": max(100, 10 * num_results),
+            "filter": lexical_query["query"]["bool"]["filter"],
+        },
+        "size": num_results,
+    }
+    for key in ("_source", "script_fields"):
+        if key in lexical_query:
+            knn_query[key] = lexical_query[key]
+    return knn_query
+
+def reciprocal_rank_fusion(lexical_results, knn_results, num_results):
+    """Merges the two hit lists by summing 1 / (rank_constant + rank) for every list a product shows up in.
+
+    Total hits and facets come from the lexical side.
+    """
+    scores = {}
+    hits = {}
+    for results in (lexical_results, knn_results):
+        for rank, hit in enumerate(results["hits"]["hits"], start=1):
+            scores[hit["_id"]] = scores.get(hit["_id"], 0) + 1 / (rank_constant + rank)
+            hits.setdefault(hit["_id"], hit)
+    top = sorted(scores, key=scores.get, reverse=True)[:num_results]
+    fused_hits = [{**hits[doc_id], "_score": scores[doc_id]} for doc_id in top]
+    return {
+        **lexical_results,
+        "hits": {
+            **lexical_results["hits"],
+            "max_score": fused_hits[0]["_score"] if fused_hits else None,
+            "hits": fused_hits,
+        },
+    }
+
+def unpack_compact_results(results):
+    """Moves the truncated description from `fields` back into `_source` so compact results format exactly like full ones"""
+    # filter_path drops hits.hits altogether when nothing matched
+    results["hits"].setdefault("hits", [])
+    for hit in results["hits"]["hits"]:
+        description = hit.pop("fields", {}).get("product_description", [""])
+        hit["_source"]["product_description"] = description[0] or ""
     return results
 
+def high_level_search(
+        query_string, 
+        availability=None, 
+        product_class=None, 
+        min_average_rating=None, 
+        num_results=10,
+        index=index_name,
+        use_cache=True,
+        compact=False,
+        hybrid=False,
+    ):
+    """Searches the catalog.
+
+    With `compact`, only the fields the formatters need come back and the description is truncated server side.
+    With `hybrid`, a kNN search on product_embedding runs next to the lexical one (in one _msearch) and the
+    two are merged with reciprocal rank fusion, so paraphrased queries still find products. If only the kNN
+    search fails, e.g. on an index without product_embedding, the lexical results are returned.
+    """
+    if search_backend == "bm25":
+        return bm25_search.high_level_search(query_string, availability, product_class, min_average_rating, num_results)
+    if hybrid:
+        kwargs = dict(query_string=query_string, availability=availability, product_class=product_class, min_average_rating=min_average_rating, num_results=num_results)
+        results = high_level_search_many([kwargs], index, use_cache, compact, hybrid)[0]
+        if isinstance(results, SearchError):
+            raise results
+        return results
+    use_cache = use_cache and search_cache.max_size > 0
+    if use_cache:
+        cache_key = search_cache_key(query_string, availability, product_class, min_average_rating, num_results, index, compact)
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    search_query = build_search_query(query_string, availability, product_class, min_average_rating, num_results, compact)
+    facets = use_facet_snapshot(search_query, query_string, availability, product_class, min_average_rating, index)
+    results = es.search(index=index, body=search_query, filter_path=compact_filter_path if compact else None).body
+    if compact:
+        results = unpack_compact_results(results)
+    if facets is not None:
+        results["aggregations"] = facets
+    if use_cache:
+        search_cache.put(cache_key, results)
+    return results
+
+
+class SearchError(Exception):
+    """A single search of a high_level_search_many batch that Elasticsearch reported as failed"""
+
+
+def prepare_msearch(list_of_kwargs, index, use_cache, compact=False, hybrid=False, check_version=True):
+    """Answers what it can from the cache and builds the _msearch body for the rest"""
+    results = [None] * len(list_of_kwargs)
+    to_send = []
+    searches = []
+    for i, kwargs in enumerate(list_of_kwargs):
+        kwargs = {"num_results": 10, "availability": None, "product_class": None, "min_average_rating": None, **kwargs}
+        try:
+            cache_key = search_cache_key(index=index, compact=compact, hybrid=hybrid, **kwargs) if use_cache else None
+            cached = search_cache.get(cache_key, check_version) if use_cache else None
+            if cached is not None:
+                results[i] = cached
+            elif hybrid:
+                window_kwargs = {**kwargs, "num_results": max(kwargs["num_results"], rank_window_size)}
+                search_query = build_search_query(compact=compact, **window_kwargs)
+                knn_query = build_knn_query(compact=compact, **window_kwargs)
+                facets = use_facet_snapshot(search_query, index=index, check_version=check_version, **window_kwargs)
+                to_send.append((i, cache_key, kwargs["num_results"], facets))
+                searches.extend([{"index": index}, search_query, {"index": index}, knn_query])
+            else:
+                search_query = build_search_query(compact=compact, **kwargs)
+                facets = use_facet_snapshot(search_query, index=index, check_version=check_version, **kwargs)
+                to_send.append((i, cache_key, kwargs["num_results"], facets))
+                searches.extend([{"index": index}, search_query])
+        except (TypeError, ValueError) as e:
+            # missing or unknown arguments only fail this search
+            results[i] = SearchError(f"bad search arguments {list_of_kwargs[i]}: {e}")
+    return results, to_send, searches
+
+def msearch_filter_path(compact):
+    if not compact:
+        return None
+    return ["responses.error", "responses.status"] + [f"responses.{path}" for path in compact_filter_path]
 
-def format_hit_for_human(hit):
+def collect_msearch(results, to_send, responses, use_cache, compact=False, hybrid=False):
+    """Fills in `results` from the _msearch responses, caching the successful ones"""
+    responses = iter(responses)
+    for i, cache_key, num_results, facets in to_send:
+        # hybrid searches have a lexical and a knn response each
+        search_responses = [next(responses) for _ in range(2 if hybrid else 1)]
+        if "error" in search_responses[0]:
+            results[i] = SearchError(search_responses[0]["error"])
+            continue
+        # an index built before product_embedding existed fails the knn half only, so fall back to the lexical hits
+        knn_failed = hybrid and "error" in search_responses[1]
+        if knn_failed:
+            search_responses[1] = {"hits": {"hits": []}}
+        if compact:
+            search_responses = [unpack_compact_results(response) for response in search_responses]
+        response = reciprocal_rank_fusion(*search_responses, num_results) if hybrid else search_responses[0]
+        if facets is not None:
+            response["aggregations"] = facets
+        results[i] = response
+        # lexical-only fallbacks aren't cached, so hybrid results come back as soon as the knn side works again
+        if use_cache and not knn_failed:
+            search_cache.put(cache_key, response)
+
+def bm25_search_many(list_of_kwargs):
+    """high_level_search_many on the bm25 backend, with bad arguments failing only their own search"""
+    results = []
+    for kwargs in list_of_kwargs:
+        try:
+            results.append(bm25_search.high_level_search(**kwargs))
+        except TypeError as e:
+            results.append(SearchError(f"bad search arguments {kwargs}: {e}"))
+    return results
+
+def high_level_search_many(list_of_kwargs, index=index_name, use_cache=True, compact=False, hybrid=False):
+    """Runs several high_level_search calls in a single _msearch round trip.
+
+    Takes a list of keyword argument dicts for high_level_search and returns the results in the
+    same order. Cached searches are answered locally and only the rest are sent. A search that fails
+    comes back as a SearchError instead of results, so one bad search doesn't sink the others.
+    """
+    if search_backend == "bm25":
+        return bm25_search_many(list_of_kwargs)
+    use_cache = use_cache and search_cache.max_size > 0
+    results, to_send, searches = prepare_msearch(list_of_kwargs, index, use_cache, compact, hybrid)
+    if searches:
+        responses = es.msearch(searches=searches, filter_path=msearch_filter_path(compact))["responses"]
+        collect_msearch(results, to_send, responses, use_cache, compact, hybrid)
+    return results
+
+def get_async_es():
+    """Returns the shared AsyncElasticsearch client, creating it on first use.
+
+    ES_REQUEST_TIMEOUT (seconds, default 10) and ES_CONNECTIONS_PER_NODE (default 100) size the
+    timeouts and the connection pool shared by every coroutine.
+    """
+    global async_es
+    if async_es is None:
+        async_es = AsyncElasticsearch(
+            "http://localhost:9200",
+            api_key=api_key,
+            request_timeout=float(os.getenv("ES_REQUEST_TIMEOUT", "10")),
+            connections_per_node=int(os.getenv("ES_CONNECTIONS_PER_NODE", "100")),
+        )
+    return async_es
+
+async def close_async_es():
+    global async_es
+    if async_es is not None:
+        await async_es.close()
+        async_es = None
+
+async def async_high_level_search(
+        query_string,
+        availability=None,
+        product_class=None,
+        min_average_rating=None,
+        num_results=10,
+        index=index_name,
+        use_cache=True,
+        compact=False,
+        hybrid=False,
+    ):
+    """Async version of high_level_search. Builds the same query and shares the same result cache"""
+    if search_backend == "bm25":
+        # searching (and building the index on first use) blocks, so it runs in a thread instead of on the event loop
+        return await asyncio.to_thread(bm25_search.high_level_search, query_string, availability, product_class, min_average_rating, num_results)
+    if hybrid:
+        kwargs = dict(query_string=query_string, availability=availability, product_class=product_class, min_average_rating=min_average_rating, num_results=num_results)
+        results = (await async_high_level_search_many([kwargs], index, use_cache, compact, hybrid))[0]
+        if isinstance(results, SearchError):
+            raise results
+        return results
+    use_cache = use_cache and search_cache.max_size > 0
+    if use_cache:
+        await search_cache.async_check_index_version()
+        cache_key = search_cache_key(query_string, availability, product_class, min_average_rating, num_results, index, compact)
+        cached = search_cache.get(cache_key, check_version=False)
+        if cached is not None:
+            return cached
+
+    search_query = build_search_query(query_string, availability, product_class, min_average_rating, num_results, compact)
+    if facet_mode == "snapshot":
+        await facet_snapshot.async_check_index_version()
+    facets = use_facet_snapshot(search_query, query_string, availability, product_class, min_average_rating, index, check_version=False)
+    results = (await get_async_es().search(index=index, body=search_query, filter_path=compact_filter_path if compact else None)).body
+    if compact:
+        results = unpack_compact_results(results)
+    if facets is not None:
+        results["aggregations"] = facets
+    if use_cache:
+        search_cache.put(cache_key, results)
+    return results
+
+async def async_high_level_search_many(list_of_kwargs, index=index_name, use_cache=True, compact=False, hybrid=False):
+    """Async version of high_level_search_many"""
+    if search_backend == "bm25":
+        return await asyncio.to_thread(bm25_search_many, list_of_kwargs)
+    use_cache = use_cache and search_cache.max_size > 0
+    if use_cache:
+        await search_cache.async_check_index_version()
+    if facet_mode == "snapshot":
+        await facet_snapshot.async_check_index_version()
+    results, to_send, searches = prepare_msearch(list_of_kwargs, index, use_cache, compact, hybrid, check_version=False)
+    if searches:
+        responses = (await get_async_es().msearch(searches=searches, filter_path=msearch_filter_path(compact)))["responses"]
+        collect_msearch(results, to_send, responses, use_cache, compact, hybrid)
+    return results
+
+
+def format_hit_for_human(hit, description_chars=description_max_chars):
     """Prints score, product_id, product_name, and category_hierarchy, truncated prodiuct_description (150 characters) rating_count, average_rating, and review_count"""
     result = []
     # result.append(f"Score: {hit['_score']}")
@@ -101,7 +698,8 @@ def format_hit_for_human(hit):
     result.append(f"Product Name: {hit['_source']['product_name']}")
     # result.append(f"Category Hierarchy: {hit['_source']['category_hierarchy']}")
     result.append(f"Product Class: {hit['_source']['product_class']}")
-    result.append(f"Product Description: {hit['_source']['product_description'][:750]}...")
+    if description_chars:
+        result.append(f"Product Description: {hit['_source']['product_description'][:description_chars]}...")
     # result.append(f"Rating Count: {hit['_source']['rating_count']}")
     result.append(f"Average Rating: {hit['_source']['average_rating']}")
     # result.append(f"Review Count: {hit['_source']['review_count']}")
@@ -118,14 +716,16 @@ def format_results_for_human(results):
     for hit in results['hits']['hits']:
         print(format_hit_for_human(hit))
 
-def format_aggs_for_human(aggs):
+def format_aggs_for_human(aggs, max_buckets=None):
     """Returns a list of strings, each representing a bucket in the aggs"""
     result = []
     for agg_name, agg_data in aggs.items():
         result.append(f"\n{agg_name}:")
-        for bucket in agg_data['buckets']:
-            if bucket['key'] != '':
-                result.append(f"  {bucket['key']}: {bucket['doc_count']}")
+        buckets = [bucket for bucket in agg_data['buckets'] if bucket['key'] != '']
+        for bucket in buckets[:max_buckets]:
+            result.append(f"  {bucket['key']}: {bucket['doc_count']}")
+        if max_buckets is not None and len(buckets) > max_buckets:
+            result.append(f"  ({len(buckets) - max_buckets} more)")
     return "Facet Counts:\n" + "\n".join(result)
 
 def format_results_for_toolcall(results):
@@ -134,6 +734,54 @@ def format_results_for_toolcall(results):
     aggs = format_aggs_for_human(results['aggregations'])
     return f"{hits}\n\n{aggs}"
 
+toolcall_token_counter = TokenCounter()
+# each step trims the tool output further: (hits described in full, their description length, the other hits' description length, facet buckets per facet)
+budget_steps = [
+    (3, description_max_chars, description_max_chars, None),
+    (3, description_max_chars, 300, 10),
+    (3, 400, 120, 10),
+    (3, 250, 0, 5),
+    (1, 150, 0, 5),
+]
+
+def name_words(hit):
+    return set(re.findall(r"[a-z0-9]+", hit['_source']['product_name'].lower()))
+
+def drop_near_duplicates(hits, threshold=0.8):
+    """Drops hits whose product class matches, and whose name shares `threshold` of its words with, a higher ranked hit"""
+    kept = []
+    for hit in hits:
+        words = name_words(hit)
+        if not any(
+            hit['_source']['product_class'] == other['_source']['product_class']
+            and len(words & name_words(other)) >= threshold * len(words | name_words(other))
+            for other in kept
+        ):
+            kept.append(hit)
+    return kept
+
+def format_hits_and_aggs(hits, aggs, top_n, top_chars, rest_chars, max_buckets):
+    text = "\n".join(format_hit_for_human(hit, top_chars if rank < top_n else rest_chars) for rank, hit in enumerate(hits))
+    return f"{text}\n\n{format_aggs_for_human(aggs, max_buckets)}"
+
+def format_results_within_budget(results, token_budget):
+    """Like format_results_for_toolcall, but fits the text in `token_budget` tokens where it can. Returns (text, tokens)
+
+    Near-duplicate products are dropped, lower ranked hits get shorter descriptions (or none) and facets fewer buckets,
+    one step at a time until the text fits. As a last resort hits are dropped from the bottom, leaving at least one.
+    """
+    hits = drop_near_duplicates(results['hits']['hits'])
+    for step in budget_steps:
+        text = format_hits_and_aggs(hits, results['aggregations'], *step)
+        tokens = toolcall_token_counter.count_text(text)
+        if tokens <= token_budget:
+            return text, tokens
+    while len(hits) > 1 and tokens > token_budget:
+        hits = hits[:-1]
+        text = format_hits_and_aggs(hits, results['aggregations'], *budget_steps[-1])
+        tokens = toolcall_token_counter.count_text(text)
+    return text, tokens
+
 if __name__ == "__main__":
     print(format_results_for_toolcall(high_level_search("standing desk", min_average_rating=3.9, num_results=5)))
     print('\n'*10)
@@ -0,0 +1,77 @@
+"""Chat sessions saved in SQLite, so a conversation survives restarts and can be picked up by any worker.
+
+Each message is one row, keyed by session ID and position, holding the message as compact JSON (no nulls, no
+whitespace). A turn's messages are appended in one transaction, and a session is only read when a conversation
+with its ID is created. Two workers appending to the same position of a session is a SessionConflict, rather
+than a silently forked history.
+
+    store = SessionStore("sessions.sqlite")
+    conversation = Conversation(model, tools, tool_lookup, system, store=store)
+    ...
+    Conversation(model, tools, tool_lookup, system, store=store, session_id=conversation.session_id)
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from context_window import message_dict
+
+session_store_path = os.getenv("SESSION_STORE_PATH", "./sessions.sqlite")
+
+
+class SessionConflict(Exception):
+    """Another conversation appended to the session first"""
+
+
+def dump_message(message):
+    message = {key: value for key, value in message_dict(message).items() if value is not None and value != []}
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class SessionStore:
+    def __init__(self, path=session_store_path):
+        # WAL lets worker processes read while another one writes, and they wait for each other's writes
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages (session_id TEXT, position INTEGER, message TEXT, created REAL, "
+            "PRIMARY KEY (session_id, position)) WITHOUT ROWID"
+        )
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def load(self, session_id):
+        """The session's messages as dicts, oldest first. An unknown session is empty"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY position", (session_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, session_id, messages, start):
+        """Saves `messages` at positions `start` onwards, all or none of them"""
+        now = time.time()
+        rows = [(session_id, start + i, dump_message(message), now) for i, message in enumerate(messages)]
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.executemany("INSERT INTO messages (session_id, position, message, created) VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.IntegrityError:
+                raise SessionConflict(f"Session {session_id} already has a message at position {start} or later")
+
+    def delete(self, session_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def sessions(self):
+        """(session ID, message count, last saved) for every session, most recent first"""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT session_id, COUNT(*), MAX(created) FROM messages GROUP BY session_id ORDER BY MAX(created) DESC"
+            ).fetchall()
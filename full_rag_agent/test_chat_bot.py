@@ -0,0 +1,73 @@
+"""Tests for Conversation.call_tools: python -m pytest full_rag_agent"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from chat_bot import Conversation
+
+
+def tool_call(id, name, arguments):
+    return SimpleNamespace(id=id, function=SimpleNamespace(name=name, arguments=arguments if isinstance(arguments, str) else json.dumps(arguments)))
+
+
+def search_catalog(query_string, product_class=None):
+    return f"results for {query_string}"
+
+def search_catalog_batch(list_of_kwargs):
+    # like rag_bot's batch: it assumes every call has a query_string
+    return [f"batched results for {kwargs['query_string']}" for kwargs in list_of_kwargs]
+
+search_catalog.batch = search_catalog_batch
+
+
+@pytest.fixture
+def conversation(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    return Conversation("test", [], {"search_catalog": search_catalog})
+
+
+def test_bad_calls_in_a_round_fail_alone(conversation):
+    results = conversation.call_tools([
+        tool_call("a", "search_catalog", {"query_string": "standing desk"}),
+        tool_call("b", "search_catalog", {}),
+        tool_call("c", "search_catalog", {"query_string": "oak desk", "color": "red"}),
+        tool_call("d", "search_catalog", '{"query_string": '),
+        tool_call("e", "no_such_tool", {}),
+        tool_call("f", "search_catalog", {"query_string": "oak desk", "product_class": "Desks"}),
+    ])
+    assert results[0] == "batched results for standing desk"
+    assert results[1].startswith("Error: search_catalog failed with ValueError") and "query_string" in results[1]
+    assert results[2].startswith("Error: search_catalog failed with ValueError") and "color" in results[2]
+    assert results[3].startswith("Error: search_catalog failed with JSONDecodeError")
+    assert results[4] == "Error: no_such_tool failed with ValueError: unknown tool 'no_such_tool'"
+    assert results[5] == "batched results for oak desk"
+
+
+def test_failed_calls_are_not_memoized(conversation):
+    conversation.call_tools([tool_call("a", "search_catalog", {"query_string": "sofa", "color": "red"})])
+    results = conversation.call_tools([
+        tool_call("b", "search_catalog", {"query_string": "sofa"}),
+        tool_call("c", "search_catalog", {"query_string": "sofa", "color": "red"}),
+    ])
+    assert results[0] == "batched results for sofa"
+    assert results[1].startswith("Error: search_catalog failed with ValueError")
+
+
+def test_budget_ends_turn_when_server_ignores_tool_choice(monkeypatch):
+    from llm_utils import mock_openai
+
+    server, mock = mock_openai.start(port=0)
+    # answers every request with a tool call, tool_choice="none" included
+    mock.reply = lambda request: {"role": "assistant", "content": None, "tool_calls": [mock.tool_call("search_catalog", {"query_string": "sofa"})]}
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://localhost:{server.server_address[1]}/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    try:
+        conversation = Conversation("test", [], {"search_catalog": search_catalog}, max_tool_rounds=2)
+        conversation.say("sofa")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert mock.requests == 3
+    assert [hit["budget"] for hit in conversation.budget_hits] == ["tool_rounds"]
+    assert not conversation.messages[-1].tool_calls
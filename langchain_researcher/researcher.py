@@ -13,7 +13,7 @@ load_dotenv()
 tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 
 # Initialize LLM
-llm = ChatOpenAI(model="gpt-4.1", temperature=0)
+llm = ChatOpenAI(model="gpt-4.1", temperature=0, base_url=os.getenv("OPENAI_BASE_URL"))
 
 class Document(BaseModel):
     """Represents a document with title, URL, and content."""
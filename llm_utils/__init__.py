@@ -0,0 +1,2 @@
+"""Helpers shared by the apps in this repo: a record/replay cache for OpenAI API calls (completion_cache), a mock
+OpenAI server (mock_openai) and retries, backoff and hedging for chat completion calls (llm_call)."""
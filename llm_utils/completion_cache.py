@@ -0,0 +1,183 @@
+"""Record/replay cache for OpenAI API calls, shared by every app in this repo.
+
+It runs as a small OpenAI-compatible proxy, so the apps don't change: the OpenAI SDK, LangChain and DSPy (through
+litellm) all send their requests to OPENAI_BASE_URL when it is set.
+
+    python -m llm_utils.completion_cache --mode record
+    OPENAI_BASE_URL=http://localhost:8100/v1 python one_step_rag/rag.py
+
+Responses are stored in SQLite, zlib-compressed, keyed by a hash of the endpoint and the request body (model,
+messages, tools, sampling parameters, stream). Least recently used entries are evicted past --max-mb.
+Modes:
+  record       serve cached responses, forward and store everything else
+  replay       serve cached responses only, anything else is an error (offline runs)
+  passthrough  forward everything, use and store nothing
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+cache_path = Path(os.getenv("COMPLETION_CACHE_PATH", Path(__file__).parent / "completion_cache.sqlite"))
+upstream_url = os.getenv("OPENAI_UPSTREAM_URL", "https://api.openai.com/v1")
+modes = ("record", "replay", "passthrough")
+# request fields that don't change the completion
+ignored_fields = ("user", "metadata")
+
+
+def request_key(path, body):
+    """Stable hash of the endpoint and the request, with keys sorted so argument order doesn't matter"""
+    request = {k: v for k, v in body.items() if k not in ignored_fields}
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{path}\0{canonical}".encode()).hexdigest()
+
+
+class CompletionCache:
+    """SQLite table of responses with least recently used eviction once the stored bytes pass max_bytes"""
+    def __init__(self, path=cache_path, max_bytes=500 * 2**20):
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content_type TEXT, body BLOB, size INTEGER, last_used REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns (content type, body) or None"""
+        with self.lock:
+            row = self.connection.execute("SELECT content_type, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return row[0], zlib.decompress(row[1])
+
+    def put(self, key, content_type, body):
+        compressed = zlib.compress(body)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, content_type, body, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, content_type, compressed, len(compressed), time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until back under max_bytes
+        to_free = total - self.max_bytes
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if to_free <= 0:
+                break
+            keys.append((key,))
+            to_free -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+def forward(method, path, headers, body):
+    """Sends the request on to the real API and returns (status, content type, body)"""
+    request = urllib.request.Request(upstream_url.rstrip("/") + path, data=body, method=method)
+    for name in ("Authorization", "Content-Type", "OpenAI-Organization", "OpenAI-Project"):
+        if headers.get(name):
+            request.add_header(name, headers[name])
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            return response.status, response.headers.get("Content-Type", "application/json"), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get("Content-Type", "application/json"), e.read()
+
+
+def make_handler(cache, mode):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, status, content_type, body, cache_status):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Cache", cache_status)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def upstream_path(self):
+            # clients are pointed at http://host:port/v1
+            return self.path[len("/v1"):] if self.path.startswith("/v1/") else self.path
+
+        def do_GET(self):
+            status, content_type, body = forward("GET", self.upstream_path(), self.headers, None)
+            self.reply(status, content_type, body, "bypass")
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            path = self.upstream_path()
+            if mode == "passthrough":
+                self.reply(*forward("POST", path, self.headers, raw), "bypass")
+                return
+            try:
+                key = request_key(path, json.loads(raw))
+            except ValueError:
+                # not a JSON request (e.g. a file upload), nothing to key on
+                self.reply(*forward("POST", path, self.headers, raw), "bypass")
+                return
+            cached = cache.get(key)
+            if cached is not None:
+                self.reply(200, *cached, "hit")
+                return
+            if mode == "replay":
+                error = {"error": {"message": f"completion_cache: no recorded response for this request ({key[:12]})", "type": "cache_miss", "code": "cache_miss"}}
+                self.reply(404, "application/json", json.dumps(error).encode(), "miss")
+                return
+            # streamed responses are recorded whole, so they arrive all at once while recording
+            status, content_type, body = forward("POST", path, self.headers, raw)
+            if status == 200:
+                cache.put(key, content_type, body)
+            self.reply(status, content_type, body, "miss")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8100, mode="record", path=cache_path, max_bytes=500 * 2**20):
+    cache = CompletionCache(path, max_bytes)
+    server = ThreadingHTTPServer(("localhost", port), make_handler(cache, mode))
+    print(f"completion cache ({mode}) on http://localhost:{port}/v1, forwarding to {upstream_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Completion cache: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record/replay cache for OpenAI API calls")
+    parser.add_argument("--mode", choices=modes, default=os.getenv("COMPLETION_CACHE_MODE", "record"))
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--path", type=Path, default=cache_path)
+    parser.add_argument("--max-mb", type=float, default=500, help="evict least recently used responses past this size")
+    args = parser.parse_args()
+    serve(args.port, args.mode, args.path, int(args.max_mb * 2**20))
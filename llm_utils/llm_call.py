@@ -0,0 +1,125 @@
+"""Retries, backoff, deadlines and hedging for chat completion calls, shared by the apps in this repo.
+
+    llm = LLMCaller(openai.Client(), hedge_after=2.0)
+    response = llm.create(model="gpt-4.1-mini", messages=messages)
+
+Rate limits (429), server errors (5xx), timeouts and connection errors are retried with jittered exponential
+backoff (honoring Retry-After), within an overall `timeout` that also caps each attempt. With `hedge_after`, an
+attempt that hasn't answered after that many seconds gets a duplicate request, and whichever answers first wins.
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+retryable_errors = (openai.RateLimitError, openai.InternalServerError, openai.APITimeoutError, openai.APIConnectionError)
+
+
+class DeadlineExceeded(openai.OpenAIError):
+    """No time left for another attempt before the call's deadline"""
+
+
+def close_if_stream(future):
+    """A streamed response that lost a hedging race still holds its connection open"""
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it did"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMCaller:
+    def __init__(self, client, max_retries=4, initial_backoff=0.5, max_backoff=8.0, timeout=60.0, hedge_after=None, max_workers=32):
+        # the SDK's own retries would hide the attempts from us
+        self.client = client.with_options(max_retries=0)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.pool = ThreadPoolExecutor(max_workers=max_workers) if hedge_after is not None else None
+        self.lock = threading.Lock()
+        self.metrics = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.metrics[name] += n
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics)
+
+    def backoff(self, attempt, error):
+        return retry_after(error) or random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+    def attempt(self, deadline, kwargs):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("LLM call deadline exceeded")
+        self.count("attempts")
+        return self.client.with_options(timeout=remaining).chat.completions.create(**kwargs)
+
+    def hedged_attempt(self, deadline, kwargs, info):
+        """One attempt, duplicated if it hasn't answered after hedge_after seconds. The first success wins"""
+        pending = {self.pool.submit(self.attempt, deadline, kwargs)}
+        done, pending = wait(pending, timeout=min(self.hedge_after, max(deadline - time.monotonic(), 0)))
+        hedge = None
+        if not done:
+            self.count("hedges")
+            info["hedged"] = True
+            hedge = self.pool.submit(self.attempt, deadline, kwargs)
+            pending.add(hedge)
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.count("hedge_wins")
+                        info["hedge_won"] = True
+                    for loser in pending:
+                        loser.add_done_callback(close_if_stream)
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def create(self, timeout=None, deadline=None, info=None, **kwargs):
+        """chat.completions.create with retries and hedging. Gives up at `deadline` (a time.monotonic() value) or after
+        `timeout` seconds. `info`, if given, is filled in with this call's attempts and whether it was hedged"""
+        deadline = deadline or time.monotonic() + (timeout or self.timeout)
+        info = {} if info is None else info
+        info.update(attempts=0, hedged=False, hedge_won=False)
+        self.count("calls")
+        for attempt in range(self.max_retries + 1):
+            info["attempts"] += 1
+            try:
+                if self.hedge_after is None:
+                    return self.attempt(deadline, kwargs)
+                return self.hedged_attempt(deadline, kwargs, info)
+            except DeadlineExceeded:
+                self.count("failures")
+                raise
+            except retryable_errors as e:
+                delay = self.backoff(attempt, e)
+                if attempt == self.max_retries:
+                    self.count("failures")
+                    raise
+                if time.monotonic() + delay >= deadline:
+                    self.count("failures")
+                    raise DeadlineExceeded("LLM call deadline exceeded") from e
+                self.count("retries")
+                time.sleep(delay)
+            except Exception:
+                self.count("failures")
+                raise
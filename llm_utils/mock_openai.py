@@ -0,0 +1,235 @@
+"""Local stand-in for the OpenAI chat completions endpoint, for load tests and offline runs.
+
+    python -m llm_utils.mock_openai --latency lognormal:-1,0.5 --error-rate 0.02
+    OPENAI_BASE_URL=http://localhost:8200/v1 OPENAI_API_KEY=mock python full_rag_agent/rag_bot.py
+
+Replies are scripted (--script, a JSON list of rules, the first whose "match" regex is found in the last message
+wins) or templated: when tools are offered and the last message isn't a tool result, the first tool is called with
+the last user message as its required string arguments, otherwise the reply is text. Every reply has `usage`
+(estimated at 4 characters per token) and can be streamed.
+
+A script rule looks like
+    {"match": "sofa", "content": "Any color preference?"}
+    {"match": "desk", "tool_calls": [{"name": "search_catalog", "arguments": {"query_string": "standing desk"}}]}
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec):
+    """Returns a function sampling seconds from "fixed:s", "uniform:low,high", "normal:mean,stddev" or "lognormal:mu,sigma" """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(*values)
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(*values))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(*values)
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def estimate_tokens(value):
+    return len(value if isinstance(value, str) else json.dumps(value)) // 4 + 1
+
+
+class MockCompletions:
+    def __init__(self, script=(), latency="fixed:0", token_latency=0.0, error_rate=0.0, error_codes=(429, 500), retry_after=None):
+        self.script = [{**rule, "pattern": re.compile(rule.get("match", ""), re.IGNORECASE)} for rule in script]
+        self.latency = parse_latency(latency)
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def reply(self, request):
+        """Returns the assistant message dict for a chat completions request"""
+        messages = request.get("messages", [])
+        last = messages[-1] if messages else {}
+        last_content = last.get("content") or ""
+        if isinstance(last_content, list):
+            last_content = " ".join(part.get("text", "") for part in last_content)
+        for rule in self.script:
+            if rule.get("tool_calls") and request.get("tool_choice") == "none":
+                continue
+            if rule["pattern"].search(last_content):
+                message = {"role": "assistant", "content": rule.get("content")}
+                if rule.get("tool_calls"):
+                    message["tool_calls"] = [self.tool_call(call["name"], call["arguments"]) for call in rule["tool_calls"]]
+                return message
+
+        tools = request.get("tools") or []
+        if tools and last.get("role") != "tool" and request.get("tool_choice") != "none":
+            function = tools[0]["function"]
+            parameters = function.get("parameters", {})
+            arguments = {
+                name: last_content
+                for name in parameters.get("required", [])
+                if parameters.get("properties", {}).get(name, {}).get("type") == "string"
+            }
+            return {"role": "assistant", "content": None, "tool_calls": [self.tool_call(function["name"], arguments)]}
+        if last.get("role") == "tool":
+            return {"role": "assistant", "content": f"Here is what I found: {last_content[:200]}"}
+        return {"role": "assistant", "content": f"This is a mock reply to: {last_content[:200]}"}
+
+    @staticmethod
+    def tool_call(name, arguments):
+        return {
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)},
+        }
+
+    @staticmethod
+    def usage(request, message):
+        prompt_tokens = estimate_tokens(request.get("messages", [])) + estimate_tokens(request.get("tools") or "")
+        completion_tokens = estimate_tokens(message.get("content") or "") + estimate_tokens(message.get("tool_calls") or "")
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def completion(self, request, message):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}],
+            "usage": self.usage(request, message),
+        }
+
+    def chunks(self, request, message):
+        """The streamed version of the message: content split into words, tool call arguments into pieces"""
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "mock")}
+        def chunk(delta, finish_reason=None):
+            return {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        yield chunk({"role": "assistant", "content": ""})
+        for word in re.findall(r"\S+\s*", message.get("content") or ""):
+            yield chunk({"content": word})
+        for index, tool_call in enumerate(message.get("tool_calls") or []):
+            yield chunk({"tool_calls": [{"index": index, "id": tool_call["id"], "type": "function", "function": {"name": tool_call["function"]["name"], "arguments": ""}}]})
+            arguments = tool_call["function"]["arguments"]
+            for start in range(0, len(arguments), 8):
+                yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + 8]}}]})
+        yield chunk({}, "tool_calls" if message.get("tool_calls") else "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            yield {**base, "choices": [], "usage": self.usage(request, message)}
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors}
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]})
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                return
+            with mock.lock:
+                mock.requests += 1
+            time.sleep(mock.latency())
+            if random.random() < mock.error_rate:
+                with mock.lock:
+                    mock.errors += 1
+                status = random.choice(mock.error_codes)
+                headers = {"Retry-After": str(mock.retry_after)} if mock.retry_after is not None else None
+                self.send_json(status, {"error": {"message": f"Injected error {status}", "type": "server_error" if status >= 500 else "rate_limit_exceeded"}}, headers)
+                return
+
+            message = mock.reply(request)
+            if not request.get("stream"):
+                self.send_json(200, mock.completion(request, message))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in mock.chunks(request, message):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(mock.token_latency)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8200, **mock_options):
+    """Runs the mock server in the current thread until KeyboardInterrupt"""
+    mock = MockCompletions(**mock_options)
+    server = ThreadingHTTPServer(("localhost", port), make_handler(mock))
+    print(f"mock OpenAI on http://localhost:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Mock OpenAI: {mock.stats()}")
+
+
+def start(port=8200, **mock_options):
+    """Starts the mock server in a background thread and returns (server, mock) so the caller can shut it down"""
+    mock = MockCompletions(**mock_options)
+    server = ThreadingHTTPServer(("localhost", port), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, mock
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions endpoint")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--script", help="JSON file with a list of reply rules")
+    parser.add_argument("--latency", default="fixed:0", help="time before the reply: fixed:s, uniform:low,high, normal:mean,stddev or lognormal:mu,sigma (seconds)")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-codes", default="429,500", help="comma separated status codes to pick injected errors from")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with injected errors")
+    args = parser.parse_args()
+    script = []
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    serve(
+        args.port,
+        script=script,
+        latency=args.latency,
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        error_codes=tuple(int(code) for code in args.error_codes.split(",")),
+        retry_after=args.retry_after,
+    )
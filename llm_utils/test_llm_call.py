@@ -0,0 +1,93 @@
+"""Tests for LLMCaller against the local mock OpenAI server: python -m pytest llm_utils"""
+import time
+
+import openai
+import pytest
+
+from llm_utils import llm_call, mock_openai
+from llm_utils.llm_call import DeadlineExceeded, LLMCaller
+
+messages = [{"role": "user", "content": "hello"}]
+
+
+@pytest.fixture
+def mock_server():
+    """Starts a mock server with the given options on a free port and returns (client, mock)"""
+    servers = []
+
+    def start(**mock_options):
+        server, mock = mock_openai.start(port=0, **mock_options)
+        servers.append(server)
+        client = openai.Client(base_url=f"http://localhost:{server.server_address[1]}/v1", api_key="mock")
+        return client, mock
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_retries_rate_limits_and_server_errors(mock_server):
+    client, mock = mock_server(error_rate=0.5, error_codes=(429, 500, 503))
+    llm = LLMCaller(client, max_retries=30, initial_backoff=0.001, max_backoff=0.002)
+    info = {}
+    response = llm.create(model="mock", messages=messages, info=info)
+    assert response.choices[0].message.content
+    assert info["attempts"] == mock.requests == mock.errors + 1
+    assert llm.stats() == {"calls": 1, "attempts": mock.requests, "retries": mock.errors, "hedges": 0, "hedge_wins": 0, "failures": 0}
+
+
+def test_backoff_honors_retry_after(mock_server):
+    client, mock = mock_server(error_rate=1.0, error_codes=(429,), retry_after=0.2)
+    llm = LLMCaller(client, max_retries=2, initial_backoff=0.001, max_backoff=0.002)
+    start = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        llm.create(model="mock", messages=messages)
+    # two waits of Retry-After seconds, not the millisecond backoff
+    assert time.monotonic() - start >= 0.4
+    assert mock.requests == 3
+    assert llm.stats() == {"calls": 1, "attempts": 3, "retries": 2, "hedges": 0, "hedge_wins": 0, "failures": 1}
+
+
+def test_raises_deadline_exceeded(mock_server):
+    client, mock = mock_server(latency="fixed:1.0")
+    llm = LLMCaller(client, max_retries=4)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        llm.create(model="mock", messages=messages, timeout=0.3)
+    assert time.monotonic() - start < 0.9
+    assert llm.stats()["failures"] == 1
+
+    with pytest.raises(DeadlineExceeded):
+        llm.create(model="mock", messages=messages, deadline=time.monotonic() - 1)
+    assert llm.stats()["attempts"] == 1
+
+
+def test_hedge_wins_when_first_attempt_is_slow(mock_server, monkeypatch):
+    client, mock = mock_server()
+    delays = [1.0, 0.0]
+    mock.latency = lambda: delays.pop(0)
+    closed = []
+    close_if_stream = llm_call.close_if_stream
+
+    def record_close(future):
+        close_if_stream(future)
+        closed.append(future.result())
+
+    monkeypatch.setattr(llm_call, "close_if_stream", record_close)
+
+    llm = LLMCaller(client, hedge_after=0.1)
+    info = {}
+    start = time.monotonic()
+    stream = llm.create(model="mock", messages=messages, stream=True, info=info)
+    assert time.monotonic() - start < 0.9
+    assert "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+    assert info == {"attempts": 1, "hedged": True, "hedge_won": True}
+
+    # the slow first attempt finishes later and is closed, not left holding its connection
+    deadline = time.monotonic() + 3
+    while not closed and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(closed) == 1 and closed[0] is not stream
+    assert closed[0].response.is_closed
+    assert llm.stats() == {"calls": 1, "attempts": 2, "retries": 0, "hedges": 1, "hedge_wins": 1, "failures": 0}
@@ -1,10 +1,16 @@
 # python 6_observability/rag_w_observability.py
 import openai
 import json
+import os
+import sys
+from pathlib import Path
 from opentelemetry import trace
 from opentelemetry.trace import Status, StatusCode
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import ConsoleSpanExporter, BatchSpanProcessor
+# llm_utils lives at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from llm_utils.llm_call import LLMCaller
 
 # Set up OpenTelemetry tracing infrastructure
 # TracerProvider is the core component that creates and manages traces
@@ -18,7 +24,9 @@ trace.get_tracer_provider().add_span_processor(
     BatchSpanProcessor(ConsoleSpanExporter())
 )
 
-client = openai.Client()
+client = openai.Client(base_url=os.getenv("OPENAI_BASE_URL"))
+# retries rate limits and server errors with backoff, see llm_utils/llm_call.py
+llm = LLMCaller(client)
 
 def search_movies(about=None, title=None):
     """Search for movies based on the given criteria."""
@@ -125,13 +133,16 @@ def execute_tools(tool_calls, messages, model, tracer):
             final_llm_span.set_attribute("message_count", len(messages + tool_messages))
             final_llm_span.set_attribute("messages", str(messages + tool_messages))
             
-            response = client.chat.completions.create(
+            call_info = {}
+            response = llm.create(
                 model=model,
                 messages=messages + tool_messages,
                 max_tokens=200,
-                temperature=0.7
+                temperature=0.7,
+                info=call_info
             )
             # Log important LLM metrics
+            final_llm_span.set_attribute("attempts", call_info["attempts"])
             final_llm_span.set_attribute("completion_tokens", response.usage.completion_tokens)
             final_llm_span.set_attribute("prompt_tokens", response.usage.prompt_tokens)
             final_llm_span.set_attribute("completion", response.choices[0].message.content)
@@ -159,15 +170,18 @@ def movie_search(user_message):
             llm_span.set_attribute("message_count", len(messages))
             llm_span.set_attribute("messages", str(messages))
             
-            response = client.chat.completions.create(
+            call_info = {}
+            response = llm.create(
                 model=model,
                 messages=messages,
                 max_tokens=200,
                 temperature=0.7,
                 tools=[movie_search_schema], 
-                tool_choice="auto"
+                tool_choice="auto",
+                info=call_info
             )
             # Log LLM performance metrics
+            llm_span.set_attribute("attempts", call_info["attempts"])
             llm_span.set_attribute("completion_tokens", response.usage.completion_tokens)
             llm_span.set_attribute("prompt_tokens", response.usage.prompt_tokens)
             llm_span.set_attribute("completion", response.choices[0].message.content)
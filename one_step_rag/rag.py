@@ -1,7 +1,15 @@
 # python 4_rag/rag.py
 import openai
 import json
-client = openai.Client()
+import os
+import sys
+from pathlib import Path
+# llm_utils lives at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from llm_utils.llm_call import LLMCaller
+client = openai.Client(base_url=os.getenv("OPENAI_BASE_URL"))
+# retries rate limits and server errors with backoff, see llm_utils/llm_call.py
+llm = LLMCaller(client)
 
 def search_movies(about=None, title=None):
     """
@@ -91,7 +99,7 @@ def movie_search(user_message):
     # the input to the LLM.
 
     model = "gpt-4.1-mini"
-    response = client.chat.completions.create(
+    response = llm.create(
         model=model,
         messages=messages,
         max_tokens=200,
@@ -181,7 +189,7 @@ def movie_search(user_message):
         # function is executed. The results are appended to 'tool_messages'.
 
         # Get final response with tool outputs
-        response = client.chat.completions.create(
+        response = llm.create(
             model=model,
             messages=messages + tool_messages,
             max_tokens=200,